@@ -1,24 +1,139 @@
 import os
+import time
 import hashlib
+import io
+import tempfile
+import uuid
+import threading
+import re
+import csv
+import gzip
+import json
+import math
+import pickle
+import shutil
+import zipfile
 import pandas as pd
-from flask import Flask, request, redirect, url_for, render_template, flash
+from flask import Flask, Request, request, redirect, url_for, render_template, flash, make_response, jsonify, stream_with_context, send_file
+from flask import before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+import click
 from werkzeug.utils import secure_filename
-from sqlalchemy import func, distinct, and_, cast, String, Integer, Float, text
+from sqlalchemy import func, and_, or_, case, event, select, true, update, String, Integer, Float, text, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateIndex, CreateTable, DropTable
 import logging
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from abc import ABC, abstractmethod
+from functools import wraps, cached_property
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-logging.basicConfig(level=logging.DEBUG)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet snapshots are optional
+    pa = pq = None
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX exports are optional
+    Workbook = None
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///data.db'
+app.config['SNAPSHOT_FOLDER'] = 'snapshots'  # Parquet copies of accepted uploads, by MD5
+app.config['REJECT_FOLDER'] = 'rejects'  # Rows rejected by validation, one CSV per upload, by MD5
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///data.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'your_secret_key'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Max file size: 16 MB
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 2048)) * 1024 * 1024  # Max upload size, 2 GB by default
+app.config['INGEST_CHUNK_SIZE'] = 20000  # Rows parsed and inserted per batch
+app.config['REPORT_CACHE_SIZE'] = 64  # Rendered report pages kept in memory
+app.config['DATA_PAGE_SIZE'] = 500  # Rows per page of the /data browser
+app.config['DATA_PAGE_SIZE_MAX'] = 5000
+app.config['UPLOAD_SPOOL_SIZE'] = 16 * 1024 * 1024  # Uploads larger than this spill to a temp file
+app.config['INGEST_WORKERS'] = 2  # Background threads parsing uploaded files; merges run one at a time
+app.config['INGEST_JOBS_KEPT'] = 50  # Finished jobs still reported by /jobs
+app.config['REPORT_ENGINE'] = 'sql'  # 'sql' (summary tables) or 'pandas' (in-memory frames)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'  # Request/SQL timing and /metrics
+app.config['SLOW_QUERY_SECONDS'] = 0.5  # SQL statements slower than this are logged when metrics are on
+app.config['DEPLOYMENT'] = os.environ.get('DEPLOYMENT', 'development')  # 'production' for several workers sharing one SQLite file
+app.config['SQLITE_PRAGMAS'] = {}  # Set on every new database connection
+# Thresholds and units of the report rules; a request can override the scalar
+# ones in its query string (see REPORT_PARAMETER_ARGS)
+app.config['REPORT_PARAMETERS'] = {
+    'min_response_rate': 25,  # % of entitled students below which a rating is shown as "-"
+    'low_rating': 4.0,  # tabela34 lists classes rated below this...
+    'min_surveys': 5,  # ...with at least this many surveys
+    'own_unit': "Wydział Nauk Społecznych",  # tabela31/32 cover this unit, tabela33 and the analysis the others
+    # Rating ranges of the analysis, [from, to); None means no upper bound
+    'rating_buckets': {'srednie_2_3': (2.0, 3.0), 'srednie_3_4': (3.0, 4.0), 'srednie_4_5': (4.0, 5.0), 'srednie_5': (5.0, None)},
+}
+
+if app.config['DEPLOYMENT'] == 'production':
+    busy_timeout = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 15000))  # ms a connection waits for a lock
+    # WAL lets report readers keep going while an upload is being written;
+    # synchronous=NORMAL is durable in WAL mode except for the last commits on power loss.
+    app.config['SQLITE_PRAGMAS'] = {
+        'journal_mode': 'WAL',
+        'busy_timeout': busy_timeout,
+        'synchronous': 'NORMAL',
+        'cache_size': -int(os.environ.get('SQLITE_CACHE_MB', 64)) * 1024,  # negative = KiB
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_MB', 256)) * 2 ** 20,
+        'journal_size_limit': 64 * 2 ** 20,  # truncate the WAL after a big import is checkpointed
+        'temp_store': 'MEMORY',
+    }
+    # Pool per worker process: one connection per serving thread plus the ingest workers
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 8)) + app.config['INGEST_WORKERS'],
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 8)),
+        'pool_timeout': busy_timeout / 1000,
+        'connect_args': {'timeout': busy_timeout / 1000},
+    }
+
+
+class HashingSpooledFile(tempfile.SpooledTemporaryFile):
+    # Werkzeug writes the multipart body here chunk by chunk as it arrives,
+    # so the MD5 is ready as soon as the request is parsed.
+    def __init__(self, max_size):
+        super().__init__(max_size=max_size, mode='w+b')
+        self.hasher = hashlib.md5()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return super().write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+class HashingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpooledFile(app.config['UPLOAD_SPOOL_SIZE'])
+
+
+class TeeReader(io.RawIOBase):
+    # Copies everything the CSV parser reads into a second file.
+    def __init__(self, source, copy):
+        self.source = source
+        self.copy = copy
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        self.copy.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+app.request_class = HashingRequest
 
 db = SQLAlchemy(app)
-ALLOWED_EXTENSIONS = {'csv'}
+ALLOWED_EXTENSIONS = ('.csv', '.csv.gz', '.zip')  # plain, gzip- or zip-compressed exports
 
 # Configuration for excluded questions and units
 EXCLUDED_QUESTIONS = [
@@ -31,243 +146,1947 @@ INITIAL_QUESTIONS = [
     "Czy na początku wykładów cel i zakres przedmiotu został jasno określony?"
 ]
 
-EXCLUDED_UNIT = "Wydział Nauk Społecznych"
+# Questions starting with this prefix count as initial ones too
+INITIAL_QUESTION_PREFIX = "Czy na początku"
 
 # Database models
 class UploadedFile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     file_hash = db.Column(db.String(32), unique=True)  # MD5 hash of the file
     filename = db.Column(db.String(200), unique=True)
+    row_count = db.Column(db.Integer)
+    rejected_count = db.Column(db.Integer)  # Rows that failed validation, see reject_path()
+
+class Setting(db.Model):
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.String(200))
+
+# Dimensions of the survey export. Long strings are stored once here and the
+# Data fact table refers to them by integer keys.
+class Subject(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kod_przedmiotu = db.Column(db.String(100))
+    nazwa_przedmiotu = db.Column(db.String(200), index=True)
+    jezyk_prowadzenia_przedmiotu = db.Column(db.String(50))
+    __table_args__ = (db.UniqueConstraint(kod_przedmiotu, nazwa_przedmiotu, jezyk_prowadzenia_przedmiotu),)
+
+class Unit(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kod_jednostki = db.Column(db.String(100))
+    jednostka = db.Column(db.String(200), index=True)
+    __table_args__ = (db.UniqueConstraint(kod_jednostki, jednostka),)
+
+class Question(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    id_pytania = db.Column(db.Integer)
+    tresc_pytania = db.Column(db.String(500))
+    # Set by classify_dimensions(): initial questions carry uprawnieni and the
+    # response count, rated ones (all but EXCLUDED_QUESTIONS) the averages
+    poczatkowe = db.Column(db.Boolean, index=True)
+    oceniane = db.Column(db.Boolean, index=True)
+    __table_args__ = (db.UniqueConstraint(id_pytania, tresc_pytania),)
+
+class AnswerOption(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    opis_odpowiedzi_pl = db.Column(db.String(200))
+    opis_odpowiedzi_en = db.Column(db.String(200))
+    __table_args__ = (db.UniqueConstraint(opis_odpowiedzi_pl, opis_odpowiedzi_en),)
+
+# Teachers and classes keep their USOS ids as primary keys
+class Teacher(db.Model):
+    id_osoby = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    tytul = db.Column(db.String(50))
+    imie = db.Column(db.String(100))
+    nazwisko = db.Column(db.String(100))
+
+class CourseClass(db.Model):
+    id_zajec = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    kod_zajec = db.Column(db.String(50))
+    opis_zajec = db.Column(db.String(200))
 
 class Data(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.Integer, db.ForeignKey(UploadedFile.id))  # upload the row's values came from
     cykl_dydaktyczny = db.Column(db.String(100), name='cykl dydaktyczny')
-    kod_przedmiotu = db.Column(db.String(100), name='kod przedmiotu')
-    nazwa_przedmiotu = db.Column(db.String(200), name='nazwa przedmiotu')
-    jezyk_prowadzenia_przedmiotu = db.Column(db.String(50), name='język prowadzenia przedmiotu')
-    id_zajec = db.Column(db.Integer, name='id zajęć')
-    kod_zajec = db.Column(db.String(50), name='kod zajęć')
-    opis_zajec = db.Column(db.String(200), name='opis zajęć')
+    subject_id = db.Column(db.Integer, db.ForeignKey(Subject.id))
+    id_zajec = db.Column(db.Integer, db.ForeignKey(CourseClass.id_zajec), name='id zajęć')
     nr_grupy = db.Column(db.Integer, name='nr grupy')
-    id_osoby = db.Column(db.Integer, name='id osoby')
-    tytul = db.Column(db.String(50), name='tytul')
-    imie = db.Column(db.String(100), name='imie')
-    nazwisko = db.Column(db.String(100), name='nazwisko')
-    kod_jednostki = db.Column(db.String(100), name='kod jednostki')
-    jednostka = db.Column(db.String(200), name='jednostka')
-    id_pytania = db.Column(db.Integer, name='id pytania')
+    id_osoby = db.Column(db.Integer, db.ForeignKey(Teacher.id_osoby), name='id osoby')
+    unit_id = db.Column(db.Integer, db.ForeignKey(Unit.id))
+    question_id = db.Column(db.Integer, db.ForeignKey(Question.id))
     kolejnosc = db.Column(db.Integer, name='kolejność')
-    tresc_pytania = db.Column(db.String(500), name='treść pytania')
-    wartosc = db.Column(db.String(50), name='wartość')
-    opis_odpowiedzi_pl = db.Column(db.String(200), name='opis odpowiedzi (PL)')
-    opis_odpowiedzi_en = db.Column(db.String(200), name='opis odpowiedzi (EN)')
-    odp_na_wartosc = db.Column(db.String(50), name='odp_na_wartosc')
-    odp_na_pytanie = db.Column(db.String(50), name='odp_na_pytanie')
-    udzial_wart_w_pytaniu = db.Column(db.String(50), name='udzial_wart_w_pytaniu')
+    wartosc = db.Column(db.Float, name='wartość')
+    answer_id = db.Column(db.Integer, db.ForeignKey(AnswerOption.id))
+    odp_na_wartosc = db.Column(db.Integer, name='odp_na_wartosc')
+    odp_na_pytanie = db.Column(db.Integer, name='odp_na_pytanie')
+    udzial_wart_w_pytaniu = db.Column(db.Float, name='udzial_wart_w_pytaniu')
     uprawnieni = db.Column(db.Integer, name='uprawnieni')
-    udzial_wartosci_w_uprawnionych = db.Column(db.String(50), name='udzial_wartosci_w_uprawnionych')
+    udzial_wartosci_w_uprawnionych = db.Column(db.Float, name='udzial_wartosci_w_uprawnionych')
+
+    # Reports read the summary tables; Data is only read in id order (summary
+    # refresh, the /data browser), so the indexes serve the /data filters,
+    # which keep rowid order inside each index entry.
+    # ix_data_plik finds the rows carrying one upload's values when it is deleted;
+    # ux_data_klucz is the natural key uploads are merged on (DATA_NATURAL_KEY);
+    # it starts with the cycle, so it also serves the per-cycle lookups.
+    __table_args__ = (
+        db.Index('ux_data_klucz', cykl_dydaktyczny, id_zajec, nr_grupy, id_osoby, question_id, wartosc, answer_id, unique=True),
+        db.Index('ix_data_plik', file_id, cykl_dydaktyczny),
+        db.Index('ix_data_osoba', id_osoby),
+        db.Index('ix_data_jednostka', unit_id),
+        db.Index('ix_data_przedmiot', subject_id),
+    )
+
+# Every upload that contains a Data row. Overlapping exports share rows, so a
+# row is removed only when the last upload containing it is deleted.
+class DataFile(db.Model):
+    data_id = db.Column(db.Integer, db.ForeignKey(Data.id), primary_key=True)
+    file_id = db.Column(db.Integer, db.ForeignKey(UploadedFile.id), primary_key=True)
+    __table_args__ = (db.Index('ix_data_file_plik', file_id),)
+
+# Summary tables, kept up to date by refresh_summaries() inside the upload
+# transaction. The reports read these instead of re-aggregating Data. Every
+# table is partitioned by teaching cycle: the cycle leads the primary key, so a
+# report for one semester reads only that semester's summary rows. Rows
+# without a cycle are stored under ''.
+class SummaryMeasures:
+    uprawnieni = db.Column(db.Integer, nullable=False, default=0)
+    ilosc_odpowiedzi = db.Column(db.Integer, nullable=False, default=0)
+    suma_ocen = db.Column(db.Float, nullable=False, default=0)
+    liczba_ocen = db.Column(db.Integer, nullable=False, default=0)
+
+class ClassSummary(SummaryMeasures, db.Model):
+    cykl_dydaktyczny = db.Column(db.String(100), primary_key=True)
+    id_zajec = db.Column(db.Integer, primary_key=True)
+    id_osoby = db.Column(db.Integer, primary_key=True)
+    nazwa_przedmiotu = db.Column(db.String(200))
+    kod_przedmiotu = db.Column(db.String(100))
+    opis_zajec = db.Column(db.String(200))
+    jednostka = db.Column(db.String(200))
+    tytul = db.Column(db.String(50))
+    imie = db.Column(db.String(100))
+    nazwisko = db.Column(db.String(100))
+
+class TeacherSummary(SummaryMeasures, db.Model):
+    cykl_dydaktyczny = db.Column(db.String(100), primary_key=True)
+    id_osoby = db.Column(db.Integer, primary_key=True)
+    jednostka = db.Column(db.String(200), primary_key=True)
+    tytul = db.Column(db.String(50))
+    imie = db.Column(db.String(100))
+    nazwisko = db.Column(db.String(100))
+
+class SubjectSummary(SummaryMeasures, db.Model):
+    cykl_dydaktyczny = db.Column(db.String(100), primary_key=True)
+    nazwa_przedmiotu = db.Column(db.String(200), primary_key=True)
+
+class UnitSummary(SummaryMeasures, db.Model):
+    cykl_dydaktyczny = db.Column(db.String(100), primary_key=True)
+    jednostka = db.Column(db.String(200), primary_key=True)
+
+SUMMARY_MEASURES = ['uprawnieni', 'ilosc_odpowiedzi', 'suma_ocen', 'liczba_ocen']
+SUMMARY_MODELS = (ClassSummary, TeacherSummary, SubjectSummary, UnitSummary)
+
+# Columns of the USOS Ankieter export: CSV header -> (Data attribute, pandas dtype).
+# This is the single source of truth for ingestion; every loader goes through it.
+CSV_COLUMNS = {
+    'cykl dydaktyczny': ('cykl_dydaktyczny', 'string'),
+    'kod przedmiotu': ('kod_przedmiotu', 'string'),
+    'nazwa przedmiotu': ('nazwa_przedmiotu', 'string'),
+    'język prowadzenia przedmiotu': ('jezyk_prowadzenia_przedmiotu', 'string'),
+    'id zajęć': ('id_zajec', 'Int64'),
+    'kod zajęć': ('kod_zajec', 'string'),
+    'opis zajęć': ('opis_zajec', 'string'),
+    'nr grupy': ('nr_grupy', 'Int64'),
+    'id osoby': ('id_osoby', 'Int64'),
+    'tytul': ('tytul', 'string'),
+    'imie': ('imie', 'string'),
+    'nazwisko': ('nazwisko', 'string'),
+    'kod jednostki': ('kod_jednostki', 'string'),
+    'jednostka': ('jednostka', 'string'),
+    'id pytania': ('id_pytania', 'Int64'),
+    'kolejność': ('kolejnosc', 'Int64'),
+    'treść pytania': ('tresc_pytania', 'string'),
+    'wartość': ('wartosc', 'float64'),
+    'opis odpowiedzi (PL)': ('opis_odpowiedzi_pl', 'string'),
+    'opis odpowiedzi (EN)': ('opis_odpowiedzi_en', 'string'),
+    'odp_na_wartosc': ('odp_na_wartosc', 'Int64'),
+    'odp_na_pytanie': ('odp_na_pytanie', 'Int64'),
+    'udzial_wart_w_pytaniu': ('udzial_wart_w_pytaniu', 'float64'),
+    'uprawnieni': ('uprawnieni', 'Int64'),
+    'udzial_wartosci_w_uprawnionych': ('udzial_wartosci_w_uprawnionych', 'float64'),
+}
+
+# Dimensions with a surrogate id: model -> (Data foreign key, natural key attributes)
+SURROGATE_DIMENSIONS = {
+    Subject: ('subject_id', ['kod_przedmiotu', 'nazwa_przedmiotu', 'jezyk_prowadzenia_przedmiotu']),
+    Unit: ('unit_id', ['kod_jednostki', 'jednostka']),
+    Question: ('question_id', ['id_pytania', 'tresc_pytania']),
+    AnswerOption: ('answer_id', ['opis_odpowiedzi_pl', 'opis_odpowiedzi_en']),
+}
+
+# Dimensions keyed by a USOS id that Data stores as is: model -> (key, attributes)
+NATURAL_DIMENSIONS = {
+    Teacher: ('id_osoby', ['tytul', 'imie', 'nazwisko']),
+    CourseClass: ('id_zajec', ['kod_zajec', 'opis_zajec']),
+}
+
+# Export columns kept on the fact table itself
+FACT_ATTRIBUTES = [attr for attr, _ in CSV_COLUMNS.values() if attr in Data.__mapper__.c]
+
+# Natural key of a fact row: one answer of one question, for one class group
+# and teacher in a cycle. The answer option keeps apart the answers without a
+# value ("trudno powiedzieć"). Overlapping exports are merged on it; the other
+# columns are the values an upload may update.
+DATA_NATURAL_KEY = ['cykl_dydaktyczny', 'id_zajec', 'nr_grupy', 'id_osoby', 'question_id', 'wartosc', 'answer_id']
+DATA_VALUES = [attr for attr in Data.__mapper__.c.keys() if attr not in ('id', 'file_id', *DATA_NATURAL_KEY)]
+
+SQL_TYPES = {'string': String, 'Int64': Integer, 'float64': Float}
+
+# The single flat table that held the export before the schema was normalized,
+# needed by the migrations of older databases.
+def flat_data_table(name='data'):
+    return db.Table(
+        name, db.MetaData(),
+        db.Column('id', Integer, primary_key=True),
+        *[db.Column(column, SQL_TYPES[dtype], key=attr) for column, (attr, dtype) in CSV_COLUMNS.items()]
+    )
+
+def has_flat_data(connection):
+    columns = {row[1] for row in connection.execute(text("PRAGMA table_info(data)"))}
+    return 'treść pytania' in columns
+
+# Numeric columns that older databases stored as VARCHAR with a decimal comma
+NUMERIC_COLUMNS = [
+    'wartość', 'odp_na_wartosc', 'odp_na_pytanie', 'udzial_wart_w_pytaniu', 'udzial_wartosci_w_uprawnionych'
+]
+
+def migrate_numeric_values(connection):
+    columns = {row[1]: row[2] for row in connection.execute(text("PRAGMA table_info(data)"))}
+    if not any(columns.get(name, '').upper().startswith('VARCHAR') for name in NUMERIC_COLUMNS):
+        return
+
+    flat = flat_data_table()
+    quote = connection.dialect.identifier_preparer.quote
+    select_columns = []
+    for column in flat.columns:
+        name = quote(column.name)
+        if column.name in NUMERIC_COLUMNS:
+            sql_type = 'INTEGER' if isinstance(column.type, Integer) else 'REAL'
+            name = f"CAST(REPLACE(NULLIF(TRIM({name}), ''), ',', '.') AS {sql_type})"
+        select_columns.append(name)
+
+    # SQLite cannot change a column type in place, so the table is rebuilt
+    connection.execute(text("ALTER TABLE data RENAME TO data_old"))
+    flat.create(connection)
+    connection.execute(text(
+        f"INSERT INTO data ({', '.join(quote(c.name) for c in flat.columns)}) "
+        f"SELECT {', '.join(select_columns)} FROM data_old"
+    ))
+    connection.execute(text("DROP TABLE data_old"))
+
+# Splits the flat data table into the dimension tables and the slim fact table
+def migrate_normalized_schema(connection):
+    if not has_flat_data(connection):
+        return
+
+    # Index names are global in SQLite and the new table reuses them
+    indexes = connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'data' AND sql IS NOT NULL"
+    )).scalars().all()
+    for name in indexes:
+        connection.execute(text(f'DROP INDEX "{name}"'))
+    connection.execute(text("ALTER TABLE data RENAME TO data_flat"))
+    flat = flat_data_table('data_flat')
+    Data.__table__.create(connection)
+
+    for model, (_, columns) in SURROGATE_DIMENSIONS.items():
+        connection.execute(insert(model).from_select(
+            columns, select(*[flat.c[name] for name in columns]).distinct()
+        ))
+    for model, (key, attributes) in NATURAL_DIMENSIONS.items():
+        connection.execute(insert(model).from_select(
+            [key, *attributes],
+            select(flat.c[key], *[func.max(flat.c[name]) for name in attributes])
+            .where(flat.c[key].isnot(None)).group_by(flat.c[key])
+        ))
+
+    # Only the latest copy of a row loaded twice, as the natural key is unique
+    natural_key = [
+        'cykl_dydaktyczny', 'id_zajec', 'nr_grupy', 'id_osoby', 'id_pytania', 'tresc_pytania', 'wartosc',
+        'opis_odpowiedzi_pl', 'opis_odpowiedzi_en'
+    ]
+    latest = select(func.max(flat.c.id)).group_by(*[flat.c[name] for name in natural_key])
+    source = select(flat.c.id, *[flat.c[attr] for attr in FACT_ATTRIBUTES]).where(flat.c.id.in_(latest))
+    targets = [Data.__mapper__.c[attr] for attr in ['id', *FACT_ATTRIBUTES]]
+    for model, (foreign_key, columns) in SURROGATE_DIMENSIONS.items():
+        dimension = model.__table__
+        source = source.add_columns(dimension.c.id).outerjoin(dimension, and_(
+            *[dimension.c[name].is_not_distinct_from(flat.c[name]) for name in columns]
+        ))
+        targets.append(Data.__mapper__.c[foreign_key])
+    connection.execute(insert(Data).from_select(targets, source))
+    connection.execute(text("DROP TABLE data_flat"))
+    rebuild_summaries(connection)
+
+def initial_question():
+    return Question.poczatkowe
+
+def rated_question():
+    return Question.oceniane
+
+# Data rows joined to their dimensions
+def joined_data(*columns):
+    query = select(*columns).select_from(Data)
+    for model in (*SURROGATE_DIMENSIONS, *NATURAL_DIMENSIONS):
+        query = query.outerjoin(model)
+    return query
+
+# Aggregates Data rows matching the criteria per (cycle, id_zajec, id_osoby):
+# uprawnieni and the response count come from the initial question, the
+# weighted sums from all non-excluded questions.
+def class_delta(*criteria):
+    initial = initial_question()
+    rated = rated_question()
+    cykl = func.coalesce(Data.cykl_dydaktyczny, '')
+    return joined_data(
+        cykl.label('cykl_dydaktyczny'),
+        Data.id_zajec.label('id_zajec'),
+        Data.id_osoby.label('id_osoby'),
+        func.max(Subject.nazwa_przedmiotu).label('nazwa_przedmiotu'),
+        func.max(Subject.kod_przedmiotu).label('kod_przedmiotu'),
+        func.max(CourseClass.opis_zajec).label('opis_zajec'),
+        func.max(Unit.jednostka).label('jednostka'),
+        func.max(Teacher.tytul).label('tytul'),
+        func.max(Teacher.imie).label('imie'),
+        func.max(Teacher.nazwisko).label('nazwisko'),
+        func.coalesce(func.max(case((initial, Data.uprawnieni))), 0).label('uprawnieni'),
+        func.coalesce(func.sum(case((initial, Data.odp_na_wartosc))), 0).label('ilosc_odpowiedzi'),
+        func.coalesce(func.sum(case((rated, Data.wartosc * Data.odp_na_wartosc))), 0).label('suma_ocen'),
+        func.coalesce(func.sum(case((and_(rated, Data.wartosc.isnot(None)), Data.odp_na_wartosc))), 0).label('liczba_ocen')
+    ).where(
+        *criteria
+    ).group_by(
+        cykl,
+        Data.id_zajec,
+        Data.id_osoby
+    )
+
+# INSERT ... SELECT that adds the source rows onto the running sums of a
+# summary table. uprawnieni of a class is a head count, so it is not summed.
+def upsert_summary(model, source, keys, attributes=(), keep_max=()):
+    columns = [*keys, *attributes, *SUMMARY_MEASURES]
+    statement = sqlite_insert(model).from_select(columns, source)
+    table = model.__table__
+    updates = {name: func.coalesce(statement.excluded[name], table.c[name]) for name in attributes}
+    for name in SUMMARY_MEASURES:
+        if name in keep_max:
+            updates[name] = func.max(table.c[name], statement.excluded[name])
+        else:
+            updates[name] = table.c[name] + statement.excluded[name]
+    return statement.on_conflict_do_update(index_elements=keys, set_=updates)
+
+def rollup(delta, keys, attributes=()):
+    return select(
+        *[delta.c[name] for name in keys],
+        *[func.max(delta.c[name]).label(name) for name in attributes],
+        *[func.sum(delta.c[name]).label(name) for name in SUMMARY_MEASURES]
+    ).where(
+        true()  # SQLite needs a WHERE clause to parse INSERT ... SELECT ... ON CONFLICT
+    ).group_by(
+        *[delta.c[name] for name in keys]
+    )
+
+# Adds the Data rows matching the criteria (all rows by default) to every
+# summary table. Works on a session or a connection, inside the caller's
+# transaction.
+def refresh_summaries(executor, *criteria):
+    delta = class_delta(*criteria).subquery()
+    class_attributes = [
+        'nazwa_przedmiotu', 'kod_przedmiotu', 'opis_zajec', 'jednostka', 'tytul', 'imie', 'nazwisko'
+    ]
+    executor.execute(upsert_summary(
+        ClassSummary,
+        select(delta).where(true()),
+        ['cykl_dydaktyczny', 'id_zajec', 'id_osoby'], class_attributes, keep_max=['uprawnieni']
+    ))
+    teacher_keys = ['cykl_dydaktyczny', 'id_osoby', 'jednostka']
+    teacher_attributes = ['tytul', 'imie', 'nazwisko']
+    executor.execute(upsert_summary(
+        TeacherSummary, rollup(delta, teacher_keys, teacher_attributes), teacher_keys, teacher_attributes
+    ))
+    for model, key in ((SubjectSummary, 'nazwa_przedmiotu'), (UnitSummary, 'jednostka')):
+        executor.execute(upsert_summary(model, rollup(delta, ['cykl_dydaktyczny', key]), ['cykl_dydaktyczny', key]))
+
+# Summary tables only hold derived data, so a rebuild drops and recreates them:
+# their schema then always follows the models, whatever version the database
+# was created with.
+def rebuild_summaries(executor):
+    for model in SUMMARY_MODELS:
+        table = model.__table__
+        executor.execute(DropTable(table, if_exists=True))
+        executor.execute(CreateTable(table))
+        for index in table.indexes:
+            executor.execute(CreateIndex(index))
+    refresh_summaries(executor)
+
+# Data rows of the given summary partitions; '' stands for rows without a cycle
+def data_in_cycles(cycles):
+    criterion = Data.cykl_dydaktyczny.in_(cycles)
+    return or_(criterion, Data.cykl_dydaktyczny.is_(None)) if '' in cycles else criterion
+
+# Recomputes the summaries of the given cycles from Data. Cheaper than a full
+# rebuild when rows were removed, as only those cycles' rows are read.
+def rebuild_cycle_summaries(executor, cycles):
+    for model in SUMMARY_MODELS:
+        executor.execute(model.__table__.delete().where(model.cykl_dydaktyczny.in_(cycles)))
+    refresh_summaries(executor, data_in_cycles(cycles))
+
+def file_cycles(executor, file_id):
+    cycles = select(func.coalesce(Data.cykl_dydaktyczny, '')).join(DataFile).where(DataFile.file_id == file_id).distinct()
+    return executor.execute(cycles).scalars().all()
+
+# Removes one upload from Data and returns the cycles it covered; the caller
+# recomputes those summaries. Rows another upload also contains stay; the ones
+# carrying this upload's values get those of the latest such upload back.
+def delete_file_rows(executor, file_id):
+    cycles = file_cycles(executor, file_id)
+    other_files = (DataFile.data_id == Data.id, DataFile.file_id != file_id)
+    executor.execute(Data.__table__.delete().where(
+        Data.id.in_(select(DataFile.data_id).where(DataFile.file_id == file_id)),
+        ~select(DataFile.file_id).where(*other_files).exists()
+    ))
+    restore_replaced_values(executor, file_id)
+    # Left over only where the other upload has no stored copy
+    executor.execute(update(Data).where(Data.file_id == file_id).values(
+        file_id=select(func.max(DataFile.file_id)).where(*other_files).scalar_subquery()
+    ))
+    executor.execute(DataFile.__table__.delete().where(DataFile.file_id == file_id))
+    return cycles
+
+# Question classification derived from the configuration above. It is stored
+# on the dimension rows, so summaries filter on flags instead of text. The own
+# unit is a report parameter and is compared by name when reports are planned.
+def classification_fingerprint():
+    config = (EXCLUDED_QUESTIONS, INITIAL_QUESTIONS, INITIAL_QUESTION_PREFIX)
+    return hashlib.md5(repr(config).encode()).hexdigest()
+
+def classify_dimensions(executor):
+    executor.execute(update(Question).values(
+        poczatkowe=or_(
+            Question.tresc_pytania.in_(INITIAL_QUESTIONS),
+            Question.tresc_pytania.ilike(f"{INITIAL_QUESTION_PREFIX}%")
+        ),
+        oceniane=Question.tresc_pytania.notin_(EXCLUDED_QUESTIONS)
+    ))
+
+# A changed configuration only needs the dimensions reclassified and the
+# summaries rebuilt from Data; nothing has to be uploaded again.
+def apply_classification():
+    fingerprint = classification_fingerprint()
+    with db.engine.begin() as connection:
+        stored = connection.execute(select(Setting.value).where(Setting.key == 'classification')).scalar()
+        if stored == fingerprint:
+            return
+        app.logger.info("Zmieniona konfiguracja pytań, ponowna klasyfikacja")
+        classify_dimensions(connection)
+        rebuild_summaries(connection)
+        statement = sqlite_insert(Setting).values(key='classification', value=fingerprint)
+        connection.execute(statement.on_conflict_do_update(index_elements=['key'], set_={'value': fingerprint}))
+
+# create_all() does not add columns to existing tables
+def add_missing_columns(connection, *models):
+    for model in models:
+        table = model.__table__
+        existing = {row[1] for row in connection.execute(text(f'PRAGMA table_info("{table.name}")'))}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(connection.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+
+def migrate_classification_flags(connection):
+    add_missing_columns(connection, Question, Unit, ClassSummary, TeacherSummary)
+
+# Rows loaded before uploads were tracked keep file_id NULL until the next
+# rebuild-database, which reloads every upload with its id. Until then single
+# files cannot be deleted or replaced.
+UNTRACKED_ROWS_MESSAGE = "Dane wgrane przed śledzeniem plików nie są powiązane z plikami; uruchom 'flask --app app rebuild-database'."
+
+def untracked_rows(executor):
+    return executor.execute(select(Data.id).where(Data.file_id.is_(None)).limit(1)).first() is not None
+
+def migrate_file_provenance(connection):
+    add_missing_columns(connection, UploadedFile, Data)
+    if untracked_rows(connection):
+        app.logger.warning(UNTRACKED_ROWS_MESSAGE)
+
+def migrate_reject_counts(connection):
+    add_missing_columns(connection, UploadedFile)
+
+# Overlapping exports loaded before the natural key existed left some rows
+# twice; the latest copy is kept. create_missing_indexes() then adds the key.
+def migrate_natural_key(connection):
+    latest = select(func.max(Data.id)).group_by(*[Data.__mapper__.c[name] for name in DATA_NATURAL_KEY])
+    removed = connection.execute(Data.__table__.delete().where(Data.id.notin_(latest))).rowcount
+    if removed:
+        app.logger.warning("Usunięto %d powtórzonych wierszy danych", removed)
+        rebuild_summaries(connection)
+
+# The own unit became a report parameter, so units and summaries no longer
+# carry an "excluded unit" flag. Summary tables are recreated from the models.
+def migrate_drop_unit_flags(connection):
+    columns = {row[1] for row in connection.execute(text("PRAGMA table_info(unit)"))}
+    if 'wykluczona' in columns:
+        indexes = connection.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'unit' AND sql LIKE '%wykluczona%'"
+        )).scalars().all()
+        for name in indexes:
+            connection.execute(text(f'DROP INDEX "{name}"'))
+        connection.execute(text("ALTER TABLE unit DROP COLUMN wykluczona"))
+    rebuild_summaries(connection)
+
+# The cycle index duplicated the leading column of ux_data_klucz
+def migrate_drop_cycle_index(connection):
+    connection.execute(text("DROP INDEX IF EXISTS ix_data_cykl"))
+
+# Rows are linked to the upload their values came from. Earlier uploads that
+# also contained a row are not known any more; rebuild-database restores them.
+def migrate_row_files(connection):
+    connection.execute(insert(DataFile).from_select(
+        ['data_id', 'file_id'], select(Data.id, Data.file_id).where(Data.file_id.isnot(None))
+    ))
+
+# The per-class lookups this index served read the summary tables now
+def migrate_drop_class_index(connection):
+    connection.execute(text("DROP INDEX IF EXISTS ix_data_zajecia"))
+
+# Flat tables get their summaries from migrate_normalized_schema
+def migrate_summaries(connection):
+    if not has_flat_data(connection):
+        rebuild_summaries(connection)
+
+# Schema migrations for existing databases, tracked with PRAGMA user_version
+MIGRATIONS = [
+    migrate_numeric_values,
+    migrate_summaries,
+    migrate_normalized_schema,
+    migrate_classification_flags,
+    rebuild_summaries,  # summaries partitioned by teaching cycle
+    migrate_file_provenance,
+    migrate_reject_counts,
+    migrate_natural_key,
+    migrate_drop_unit_flags,
+    migrate_drop_cycle_index,
+    migrate_row_files,
+    migrate_drop_class_index,
+]
+
+def migrate_database():
+    with db.engine.begin() as connection:
+        version = connection.execute(text("PRAGMA user_version")).scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            app.logger.info("Migracja bazy danych do wersji %d: %s", number, migration.__name__)
+            migration(connection)
+            connection.execute(text(f"PRAGMA user_version = {number}"))
+
+# Indexes are not created by create_all() for tables that already exist
+def create_missing_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def configure_sqlite(engine, pragmas):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    # Workers forked after import (gunicorn --preload) open their own connections
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
 
 with app.app_context():
+    if app.config['SQLITE_PRAGMAS']:
+        configure_sqlite(db.engine, app.config['SQLITE_PRAGMAS'])
     db.create_all()
+    migrate_database()
+    create_missing_indexes()
+    apply_classification()
 
 def allowed_file(filename):
-    print(f"[DEBUG] Sprawdzanie pliku: {filename}")
-    result = '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-    print(f"[DEBUG] Czy plik jest dozwolony? {result}")
+    result = filename.lower().endswith(ALLOWED_EXTENSIONS)
+    app.logger.debug("Plik %s dozwolony: %s", filename, result)
     return result
 
-def calculate_file_hash(file_path):
-    print(f"[DEBUG] Obliczanie hash MD5 dla pliku: {file_path}")
-    hasher = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
-    file_hash = hasher.hexdigest()
-    print(f"[DEBUG] Obliczony hash MD5: {file_hash}")
-    return file_hash
-
-def parse_teacher_name(nauczyciel):
-    parts = nauczyciel.strip().split()
-    if len(parts) >= 2:
-        imie = parts[0]
-        nazwisko = ' '.join(parts[1:])
+def calculate_file_hash(stream, chunk_size=64 * 1024):
+    if isinstance(stream, HashingSpooledFile):
+        file_hash = stream.hexdigest()
     else:
-        imie = parts[0]
-        nazwisko = ''
-    return nazwisko, imie
-
-def calculate_weighted_average(data_rows):
-    total_weighted_score = 0
-    total_responses = 0
+        hasher = hashlib.md5()
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            hasher.update(chunk)
+        file_hash = hasher.hexdigest()
+    app.logger.debug("Obliczony hash MD5: %s", file_hash)
+    return file_hash
 
-    for row in data_rows:
-        try:
-            wartosc = float(row.wartosc.replace(',', '.'))
-            odp_na_wartosc = int(float(row.odp_na_wartosc.replace(',', '.')))
-            total_weighted_score += wartosc * odp_na_wartosc
-            total_responses += odp_na_wartosc
-        except (ValueError, TypeError) as e:
-            print(f"[ERROR] Błąd podczas przetwarzania wiersza: {e}")
-            continue  # Skip invalid data
-
-    average = (total_weighted_score / total_responses) if total_responses > 0 else None
-    return average, total_responses
-
-def class_details(id_zajec, id_osoby=None):
-    query = db.session.query(
-        Data.uprawnieni.label('uprawnieni_first'),
-        func.sum(cast(Data.odp_na_wartosc, Integer)).label('ilosc_odpowiedzi')
-    ).filter(
-        Data.id_zajec == id_zajec
+# Typed chunks of an export, with columns renamed to the attribute names
+# Rows without these cannot be attributed to a class, teacher or question
+REQUIRED_COLUMNS = ['id zajęć', 'id osoby', 'id pytania']
+COUNT_COLUMNS = ['odp_na_wartosc', 'odp_na_pytanie', 'uprawnieni']
+# Integers are parsed through float64, which is exact below 2**53; larger ids
+# and counts would be rounded or overflow Int64, so their rows are rejected
+MAX_INTEGER = 2 ** 53
+
+# Columns are read as text and converted here, column by column, so a bad value
+# rejects its row instead of failing the whole upload. Returns the typed chunk
+# (renamed to model attributes) and the reasons, '' for accepted rows.
+def validate_chunk(chunk):
+    reasons = pd.Series('', index=chunk.index, dtype=object)
+    typed = {}
+    for column, (attr, dtype) in CSV_COLUMNS.items():
+        values = chunk[column]
+        if dtype == 'string':
+            typed[attr] = values
+            continue
+        values = values.str.strip()
+        if dtype == 'float64':
+            values = values.str.replace(',', '.', regex=False)
+        numbers = pd.to_numeric(values, errors='coerce')
+        invalid = values.notna() & (values != '') & numbers.isna()
+        out_of_range = pd.Series(False, index=chunk.index)
+        if dtype == 'Int64':
+            invalid |= (numbers % 1 != 0).fillna(False)
+            out_of_range = (numbers.abs() >= MAX_INTEGER).fillna(False)
+        if column in COUNT_COLUMNS:
+            invalid |= (numbers < 0).fillna(False)
+        reasons[invalid] += f"{column}: nieprawidłowa wartość; "
+        reasons[out_of_range & ~invalid] += f"{column}: wartość poza zakresem; "
+        typed[attr] = numbers.mask(invalid | out_of_range).astype(dtype)
+    for column in REQUIRED_COLUMNS:
+        missing = chunk[column].str.strip().fillna('') == ''
+        reasons[missing] += f"{column}: brak wartości; "
+    return pd.DataFrame(typed, index=chunk.index), reasons.str.rstrip('; ')
+
+# Accepted rows of an export, chunk by chunk; rejected ones go to `rejects`
+# (a RejectWriter) with their reasons. The header has to contain every
+# expected column; extra columns are ignored.
+def read_csv_chunks(source, chunksize=None, rejects=None):
+    reader = pd.read_csv(
+        source,
+        delimiter=';',
+        encoding='utf-8',
+        usecols=lambda column: column in CSV_COLUMNS,
+        dtype='string',
+        chunksize=chunksize or app.config['INGEST_CHUNK_SIZE']
     )
-    
-    if id_osoby is not None:
-        query = query.filter(Data.id_osoby == id_osoby)
-    
-    query = query.filter(
-        Data.tresc_pytania.ilike("Czy na początku%")
+    with reader:
+        for chunk in reader:
+            missing = [column for column in CSV_COLUMNS if column not in chunk.columns]
+            if missing:
+                raise ValueError(f"Brak wymaganych kolumn w pliku: {', '.join(missing)}")
+            typed, reasons = validate_chunk(chunk)
+            rejected = reasons != ''
+            if rejected.any():
+                if rejects is not None:
+                    rejects.write(chunk[rejected], reasons[rejected])
+                typed = typed[~rejected]
+            yield typed
+
+# Compressed exports are decompressed as the parser reads them, so memory use
+# depends on the chunk size only. A zip archive has to hold exactly one file and
+# needs a seekable source, since its directory is at the end.
+def open_export(source, filename):
+    name = filename.lower()
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=source, mode='rb')
+    if name.endswith('.zip'):
+        archive = zipfile.ZipFile(source)
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        if len(members) != 1:
+            raise ValueError("Archiwum ZIP musi zawierać dokładnie jeden plik CSV")
+        return archive.open(members[0])
+    return source
+
+# Chunks of a stored copy in uploads/, compressed or not
+def read_stored_export(path):
+    with open(path, 'rb') as f:
+        yield from read_csv_chunks(open_export(f, path))
+
+def chunk_to_frame(chunk):
+    # Missing values (NaN / pd.NA) have to reach the database as NULL
+    return chunk.astype(object).where(chunk.notna(), None)
+
+# Parquet snapshots: every accepted upload is also stored as a typed Parquet
+# file named after its MD5, written from the chunks parsed during ingestion.
+# They let analytics and database rebuilds skip CSV parsing. Needs pyarrow;
+# without it no snapshots are written and rebuilds parse the CSV copies.
+SNAPSHOT_TYPES = {'string': 'string', 'Int64': 'int64', 'float64': 'float64'}
+
+def snapshot_schema():
+    return pa.schema([(attr, SNAPSHOT_TYPES[dtype]) for attr, dtype in CSV_COLUMNS.values()])
+
+def snapshot_path(file_hash):
+    return os.path.join(app.config['SNAPSHOT_FOLDER'], f"{file_hash}.parquet")
+
+def has_snapshot(file_hash):
+    return pq is not None and os.path.exists(snapshot_path(file_hash))
+
+# Writes the snapshot next to the ingestion; it only becomes visible under its
+# final name once the upload's transaction has been committed.
+class SnapshotWriter:
+    def __init__(self, file_hash):
+        self.path = snapshot_path(file_hash)
+        self.temp_path = self.path + '.tmp'
+        self.writer = None
+
+    def write(self, chunk):
+        if pq is None:
+            return
+        if self.writer is None:
+            os.makedirs(app.config['SNAPSHOT_FOLDER'], exist_ok=True)
+            self.writer = pq.ParquetWriter(self.temp_path, snapshot_schema())
+        self.writer.write_table(pa.Table.from_pandas(chunk, schema=self.writer.schema, preserve_index=False))
+
+    def commit(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.remove(self.temp_path)
+
+# Rejected rows of an upload with the reasons, as a CSV next to the snapshots.
+# Only created when something was rejected.
+def reject_path(file_hash):
+    return os.path.join(app.config['REJECT_FOLDER'], f"{file_hash}.csv")
+
+class RejectWriter:
+    def __init__(self, file_hash):
+        self.path = reject_path(file_hash)
+        self.temp_path = self.path + '.tmp'
+        self.rows = 0
+
+    def write(self, chunk, reasons):
+        frame = chunk[list(CSV_COLUMNS)].copy()
+        # The parser numbers rows across chunks; 1 is the first row after the header
+        frame.insert(0, 'wiersz', chunk.index + 1)
+        frame.insert(1, 'powód', reasons)
+        if self.rows == 0:
+            os.makedirs(app.config['REJECT_FOLDER'], exist_ok=True)
+        frame.to_csv(self.temp_path, sep=';', index=False, header=self.rows == 0, mode='w' if self.rows == 0 else 'a')
+        self.rows += len(frame)
+
+    def commit(self):
+        if self.rows:
+            os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        if self.rows:
+            os.remove(self.temp_path)
+
+def stored_file_hashes():
+    return [file_hash for (file_hash,) in db.session.query(UploadedFile.file_hash).order_by(UploadedFile.id)]
+
+# Typed chunks of the snapshots, in upload order. Files are memory-mapped and
+# read batch by batch, so only one batch is materialised at a time.
+def snapshot_chunks(file_hashes=None, columns=None, batch_size=None):
+    types = {pa.int64(): pd.Int64Dtype(), pa.string(): pd.StringDtype()}
+    for file_hash in stored_file_hashes() if file_hashes is None else file_hashes:
+        parquet = pq.ParquetFile(snapshot_path(file_hash), memory_map=True)
+        for batch in parquet.iter_batches(batch_size=batch_size or app.config['INGEST_CHUNK_SIZE'], columns=columns):
+            yield batch.to_pandas(types_mapper=types.get)
+
+# Resolves the dimension keys of parsed chunks to ids, adding new dimension
+# rows on the way. Surrogate ids are cached for the whole load; teachers and
+# classes are upserted so their names follow the latest export.
+class DimensionLookup:
+    def __init__(self, session):
+        self.session = session
+        self.ids = {}
+
+    def load(self, model, columns, *criteria):
+        rows = self.session.execute(
+            select(model.id, *[getattr(model, name) for name in columns]).where(*criteria)
+        )
+        return {tuple(row[1:]): row[0] for row in rows}
+
+    def resolve(self, model, columns, frame):
+        if model not in self.ids:
+            self.ids[model] = self.load(model, columns)
+        ids = self.ids[model]
+        keys = list(frame[columns].itertuples(index=False, name=None))
+        missing = set(keys).difference(ids)
+        if missing:
+            last_id = max(ids.values(), default=0)
+            self.session.execute(insert(model), [dict(zip(columns, key)) for key in missing])
+            ids.update(self.load(model, columns, model.id > last_id))
+        return [ids[key] for key in keys]
+
+    def upsert(self, model, key, attributes, frame):
+        rows = frame[[key, *attributes]].dropna(subset=[key]).drop_duplicates(subset=[key], keep='last')
+        if rows.empty:
+            return
+        statement = sqlite_insert(model)
+        table = model.__table__
+        self.session.execute(statement.on_conflict_do_update(
+            index_elements=[key],
+            set_={name: func.coalesce(statement.excluded[name], table.c[name]) for name in attributes}
+        ), rows.to_dict('records'))
+
+    def fact_records(self, chunk, file_id=None):
+        frame = chunk_to_frame(chunk)
+        for model, (key, attributes) in NATURAL_DIMENSIONS.items():
+            self.upsert(model, key, attributes, frame)
+        facts = frame[FACT_ATTRIBUTES].copy()
+        facts['file_id'] = file_id
+        for model, (foreign_key, columns) in SURROGATE_DIMENSIONS.items():
+            facts[foreign_key] = self.resolve(model, columns, frame)
+        # A key repeated within the chunk counts once, with its last values
+        return facts.drop_duplicates(DATA_NATURAL_KEY, keep='last').to_dict('records')
+
+# Every chunk is staged in a temporary table and merged into Data from there
+def staging_table():
+    return db.Table(
+        'data_staging', db.MetaData(),
+        *[db.Column(column.name, column.type, key=attr) for attr, column in Data.__mapper__.c.items() if attr != 'id'],
+        prefixes=['TEMPORARY']
     )
-    
-    record = query.first()
 
-    if record:
-        return {
-            "id_zajec": id_zajec,
-            "uprawnieni": record.uprawnieni_first if record.uprawnieni_first is not None else 0,
-            "ilosc_odpowiedzi": record.ilosc_odpowiedzi if record.ilosc_odpowiedzi is not None else 0
-        }
-    else:
+def staged_key(staging):
+    data = Data.__mapper__.c
+    return and_(*[data[name].is_not_distinct_from(staging.c[name]) for name in DATA_NATURAL_KEY])
+
+# Copies the values and the upload of staged rows onto the Data rows with the same key
+def update_from_staging(staging, *criteria):
+    data = Data.__mapper__.c
+    return update(Data).values(
+        {data[name]: staging.c[name] for name in ['file_id', *DATA_VALUES]}
+    ).where(staged_key(staging), *criteria)
+
+# Merges the staged rows into Data on DATA_NATURAL_KEY: new keys are inserted,
+# rows whose values differ are updated (and now belong to the new upload),
+# identical ones are skipped. Either way the row is linked to the staged upload
+# in DataFile. Returns the inserted and updated counts and the cycles of the
+# updated rows, whose summaries have to be recomputed.
+def merge_staged_rows(session, staging):
+    data = Data.__mapper__.c
+    same_key = staged_key(staging)
+    changed = or_(*[data[name].is_distinct_from(staging.c[name]) for name in DATA_VALUES])
+    cycles = session.execute(
+        select(func.coalesce(staging.c.cykl_dydaktyczny, '')).distinct().where(
+            select(Data.id).where(same_key, changed).exists()
+        )
+    ).scalars().all()
+    updated = session.execute(update_from_staging(staging, changed)).rowcount if cycles else 0
+    columns = [name for name in staging.c.keys()]
+    inserted = session.execute(insert(Data).from_select(
+        [data[name] for name in columns],
+        select(*[staging.c[name] for name in columns]).where(~select(Data.id).where(same_key).exists())
+    )).rowcount
+    session.execute(sqlite_insert(DataFile).from_select(
+        ['data_id', 'file_id'],
+        select(Data.id, staging.c.file_id).select_from(staging).join(Data, same_key).where(staging.c.file_id.isnot(None))
+    ).on_conflict_do_nothing())
+    session.execute(staging.delete())
+    return inserted, updated, cycles
+
+# Typed chunks of a stored upload: its Parquet snapshot, or else its CSV copy
+# in uploads/. None when neither is there.
+def stored_chunks(uploaded):
+    if has_snapshot(uploaded.file_hash):
+        return snapshot_chunks([uploaded.file_hash])
+    path = os.path.join(app.config['UPLOAD_FOLDER'], uploaded.filename)
+    return read_stored_export(path) if os.path.exists(path) else None
+
+# Before an upload is deleted, the rows it last updated but other uploads also
+# contain get the values of the latest of those uploads back, re-read from its
+# stored copy and merged on the natural key. Rows of an upload without a stored
+# copy keep their values.
+def restore_replaced_values(session, file_id):
+    latest_file = select(func.max(DataFile.file_id)).where(
+        DataFile.data_id == Data.id, DataFile.file_id != file_id
+    ).scalar_subquery()
+    sources = session.execute(select(latest_file).where(Data.file_id == file_id).distinct()).scalars().all()
+    sources = [source for source in sources if source is not None]
+    if not sources:
+        return
+
+    lookup = DimensionLookup(session)
+    staging = staging_table()
+    connection = session.connection()
+    staging.drop(connection, checkfirst=True)
+    staging.create(connection)
+    for source in sources:
+        uploaded = session.get(UploadedFile, source)
+        chunks = stored_chunks(uploaded)
+        if chunks is None:
+            app.logger.warning("Brak kopii pliku %s, jego wartości nie zostały przywrócone", uploaded.filename)
+            continue
+        for chunk in chunks:
+            records = lookup.fact_records(chunk, source)
+            if records:
+                session.execute(insert(staging), records)
+                session.execute(update_from_staging(staging, Data.file_id == file_id, latest_file == source))
+                session.execute(staging.delete())
+    staging.drop(connection)
+
+# Bulk-loads an export into Data and its dimensions, one executemany batch per
+# chunk, and brings the summary tables up to date. Rows already in Data (by
+# their natural key) are updated or skipped. The caller owns the transaction.
+def ingest_csv(source, chunksize=None, progress=None, snapshot=None, file_id=None, summaries=True, rejects=None):
+    return ingest_chunks(read_csv_chunks(source, chunksize, rejects), progress, snapshot, file_id, summaries)
+
+def ingest_chunks(chunks, progress=None, snapshot=None, file_id=None, summaries=True):
+    started = time.perf_counter()
+    last_id = db.session.query(func.max(Data.id)).scalar() or 0
+    lookup = DimensionLookup(db.session)
+    staging = staging_table()
+    connection = db.session.connection()
+    staging.drop(connection, checkfirst=True)
+    staging.create(connection)
+    rows = inserted = updated = 0
+    updated_cycles = set()
+    for chunk in chunks:
+        if snapshot is not None:
+            snapshot.write(chunk)
+        records = lookup.fact_records(chunk, file_id)
+        if records:
+            db.session.execute(insert(staging), records)
+            chunk_inserted, chunk_updated, cycles = merge_staged_rows(db.session, staging)
+            inserted += chunk_inserted
+            updated += chunk_updated
+            updated_cycles.update(cycles)
+        rows += len(chunk)
+        if progress:
+            progress(rows)
+    staging.drop(connection)
+
+    if summaries:
+        classify_dimensions(db.session)
+        # Inserted rows are added to the running sums; cycles with updated rows
+        # are recomputed, as their old values are already in the sums.
+        cycles = sorted(updated_cycles)
+        refresh_summaries(db.session, Data.id > last_id, func.coalesce(Data.cykl_dydaktyczny, '').notin_(cycles))
+        if cycles:
+            rebuild_cycle_summaries(db.session, cycles)
+
+    seconds = time.perf_counter() - started
+    stats = {
+        "rows": rows,
+        "inserted": inserted,
+        "updated": updated,
+        "skipped": rows - inserted - updated,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds > 0 else rows
+    }
+    app.logger.info(
+        "Załadowano %(rows)d wierszy w %(seconds)ss (%(rows_per_second)d wierszy/s): "
+        "%(inserted)d nowych, %(updated)d zaktualizowanych, %(skipped)d pominiętych", stats
+    )
+    return stats
+
+def rounded_average(suma_ocen, liczba_ocen):
+    return round(suma_ocen / liczba_ocen, 2) if liczba_ocen else None
+
+
+
+# Teaching cycles are written either with the calendar year ("2023Z" is the
+# winter semester of 2023/24, "2024L" its summer semester) or with the
+# academic year ("2023/24Z", "2023/24L", "2023/24"). The sort key maps both to
+# (academic year, semester), so ranges follow the calendar; unknown formats
+# sort after the known ones.
+CYCLE_PATTERN = re.compile(r'^(\d{4})(/\d{2})?([ZL]?)$')
+
+def cycle_sort_key(cykl):
+    match = CYCLE_PATTERN.match(cykl.strip().upper())
+    if not match:
+        return (1, 0, 0, cykl)
+    year, academic, semester = match.groups()
+    year = int(year)
+    if semester == 'L' and not academic:
+        year -= 1
+    return (0, year, {'': 0, 'Z': 1, 'L': 2}[semester], cykl)
+
+def known_cycles():
+    rows = db.session.query(ClassSummary.cykl_dydaktyczny).distinct()
+    return sorted((cykl for (cykl,) in rows if cykl), key=cycle_sort_key)
+
+# Cycles selected by the query string: repeated ?cykl= values and/or an
+# inclusive ?cykl_od=&cykl_do= range. None means every cycle.
+def selected_cycles(args):
+    chosen = [cykl for cykl in args.getlist('cykl') if cykl]
+    start, end = args.get('cykl_od'), args.get('cykl_do')
+    if not chosen and not start and not end:
+        return None
+    cycles = chosen or known_cycles()
+    if start:
+        cycles = [cykl for cykl in cycles if cycle_sort_key(cykl) >= cycle_sort_key(start)]
+    if end:
+        cycles = [cykl for cykl in cycles if cycle_sort_key(cykl) <= cycle_sort_key(end)]
+    return sorted(set(cycles), key=cycle_sort_key)
+
+# Unit selected by ?unit=; the reports are then computed from its classes only
+def selected_unit(args):
+    return args.get('unit') or None
+
+def cycle_criteria(model, cycles):
+    return [] if cycles is None else [model.cykl_dydaktyczny.in_(cycles)]
+
+# Template context of the cycle selector shown above the reports
+def cycle_filter(cycles):
+    return {
+        'cykle': known_cycles(),
+        'w_raporcie': cycles,
+        'wybrane': request.args.getlist('cykl'),
+        'od': request.args.get('cykl_od', ''),
+        'do': request.args.get('cykl_do', ''),
+        'eksport': request.path.strip('/') if request.path.strip('/') in REPORT_EXPORTS else None
+    }
+
+
+
+# Report engines. Every table is described declaratively in REPORT_DEFINITIONS
+# and computed by ReportPlan from one frame of per-(id_zajec, id_osoby) pair
+# statistics over the selected cycles. REPORT_ENGINE selects where the pairs
+# come from: 'sql' reads them from ClassSummary, 'pandas' aggregates Data.
+# All tables of one selection share the pairs and the derived class, teacher
+# and subject aggregates, so a dashboard of every table costs one scan.
+
+PAIR_ATTRIBUTES = ['nazwa_przedmiotu', 'kod_przedmiotu', 'opis_zajec', 'jednostka', 'tytul', 'imie', 'nazwisko']
+
+# Text columns as categoricals ordered like SQLite compares them, so min/max
+# and sorting give the same answers as ORDER BY in the database.
+def order_like_sqlite(frame, columns):
+    for name in columns:
+        values = frame[name].dropna().unique()
+        frame[name] = pd.Categorical(frame[name], categories=sorted(values), ordered=True)
+    return frame
+
+def pair_measures(pairs):
+    for name in ['id_zajec', 'id_osoby']:
+        pairs[name] = pairs[name].astype('Int64')
+    for name in ['uprawnieni', 'ilosc_odpowiedzi', 'liczba_ocen']:
+        pairs[name] = pairs[name].fillna(0).astype('int64')
+    pairs['suma_ocen'] = pairs['suma_ocen'].fillna(0).astype('float64')
+    return pairs
+
+# Pair frames of one dataset version, optionally restricted to the classes of
+# one unit. Plans for the last few cycle selections, units and parameters are
+# kept, as the same semester tends to be asked for again.
+class PairDataset(ABC):
+    PLANS_KEPT = 16
+
+    def __init__(self, version):
+        self.version = version
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reports(self, cycles=None, parameters=None, unit=None):
+        parameters = parameters or report_parameters()
+        key = (None if cycles is None else tuple(cycles), unit, parameters_key(parameters))
+        with self._lock:
+            if key not in self._plans:
+                self._plans[key] = ReportPlan(self.pairs(cycles, unit), parameters)
+                while len(self._plans) > self.PLANS_KEPT:
+                    self._plans.popitem(last=False)
+            self._plans.move_to_end(key)
+            return self._plans[key]
+
+    @abstractmethod
+    def pairs(self, cycles, unit=None):
+        ...
+
+# SQL engine: one grouped query over the summary table per cycle selection
+class SummaryDataset(PairDataset):
+    def pairs(self, cycles, unit=None):
+        query = select(
+            ClassSummary.id_zajec,
+            ClassSummary.id_osoby,
+            *(func.max(getattr(ClassSummary, name)).label(name) for name in PAIR_ATTRIBUTES),
+            func.max(ClassSummary.uprawnieni).label('uprawnieni'),
+            func.sum(ClassSummary.ilosc_odpowiedzi).label('ilosc_odpowiedzi'),
+            func.sum(ClassSummary.suma_ocen).label('suma_ocen'),
+            func.sum(ClassSummary.liczba_ocen).label('liczba_ocen')
+        ).where(
+            *cycle_criteria(ClassSummary, cycles)
+        ).group_by(
+            ClassSummary.id_zajec,
+            ClassSummary.id_osoby
+        )
+        if unit:
+            query = query.where(ClassSummary.jednostka == unit)
+        rows = db.session.execute(query).all()
+        columns = ['id_zajec', 'id_osoby', *PAIR_ATTRIBUTES, 'uprawnieni', 'ilosc_odpowiedzi', 'suma_ocen', 'liczba_ocen']
+        return pair_measures(order_like_sqlite(pd.DataFrame(rows, columns=columns), PAIR_ATTRIBUTES))
+
+# Pandas engine: loads the Data columns the reports need once per dataset
+# version and aggregates them per (cycle, id_zajec, id_osoby), like ClassSummary.
+class FrameDataset(PairDataset):
+    def __init__(self, version):
+        super().__init__(version)
+        columns = [
+            Data.cykl_dydaktyczny, Data.id_zajec, Data.id_osoby, Teacher.tytul, Teacher.imie, Teacher.nazwisko,
+            Subject.nazwa_przedmiotu, Subject.kod_przedmiotu, CourseClass.opis_zajec, Unit.jednostka,
+            Question.poczatkowe, Question.oceniane,
+            Data.wartosc, Data.odp_na_wartosc, Data.uprawnieni
+        ]
+        rows = db.session.execute(joined_data(*columns)).all()
+        frame = order_like_sqlite(pd.DataFrame(rows, columns=[column.key for column in columns]), PAIR_ATTRIBUTES)
+        for name in ['id_zajec', 'id_osoby', 'odp_na_wartosc', 'uprawnieni']:
+            frame[name] = frame[name].astype('Int64')
+        frame['wartosc'] = frame['wartosc'].astype('float64')
+        frame['cykl_dydaktyczny'] = frame['cykl_dydaktyczny'].fillna('')
+        self.cycle_pairs = self._pair_statistics(frame)
+
+    # Pairs over the selected cycles, merged like class_statistics() does
+    def pairs(self, cycles, unit=None):
+        pairs = self.cycle_pairs
+        if cycles is not None:
+            pairs = pairs[pairs['cykl_dydaktyczny'].isin(cycles)]
+        if unit:
+            pairs = pairs[pairs['jednostka'] == unit]
+        return pairs.groupby(['id_zajec', 'id_osoby'], dropna=False, observed=True).agg(
+            **{name: (name, 'max') for name in PAIR_ATTRIBUTES},
+            uprawnieni=('uprawnieni', 'max'),
+            ilosc_odpowiedzi=('ilosc_odpowiedzi', 'sum'),
+            suma_ocen=('suma_ocen', 'sum'),
+            liczba_ocen=('liczba_ocen', 'sum')
+        ).reset_index()
+
+    # Same measures as class_delta(): uprawnieni and the response count from
+    # the initial question, the weighted sums from the rated ones.
+    @staticmethod
+    def _pair_statistics(frame):
+        initial = frame['poczatkowe'].eq(True)
+        rated = frame['oceniane'].eq(True)
+        wartosc = frame['wartosc']
+        odp = frame['odp_na_wartosc'].astype('float64')
+        frame = frame.assign(
+            _uprawnieni=frame['uprawnieni'].astype('float64').where(initial),
+            _odpowiedzi=odp.where(initial),
+            _suma=(wartosc * odp).where(rated),
+            _liczba=odp.where(rated & wartosc.notna())
+        )
+        pairs = frame.groupby(['cykl_dydaktyczny', 'id_zajec', 'id_osoby'], dropna=False, observed=True).agg(
+            **{name: (name, 'max') for name in PAIR_ATTRIBUTES},
+            uprawnieni=('_uprawnieni', 'max'),
+            ilosc_odpowiedzi=('_odpowiedzi', 'sum'),
+            suma_ocen=('_suma', 'sum'),
+            liczba_ocen=('_liczba', 'sum')
+        ).reset_index()
+        return pair_measures(pairs)
+
+# Report parameters: the thresholds of the report rules and the unit treated
+# as the faculty's own. Defaults come from REPORT_PARAMETERS; the query string
+# can override them for one request, e.g. /tabela34?prog_oceny=3.5.
+REPORT_PARAMETER_ARGS = {
+    'prog_ankiet': ('min_response_rate', float),
+    'prog_oceny': ('low_rating', float),
+    'min_ankiet': ('min_surveys', int),
+    'jednostka_wlasna': ('own_unit', str),
+}
+
+def report_parameters(args=None):
+    parameters = dict(app.config['REPORT_PARAMETERS'])
+    for arg, (name, convert) in REPORT_PARAMETER_ARGS.items():
+        value = args.get(arg, type=convert) if args is not None else None
+        if value is not None and value != '':
+            parameters[name] = value
+    return parameters
+
+def parameters_key(parameters):
+    return tuple(parameters[name] for name, _ in REPORT_PARAMETER_ARGS.values())
+
+def rounded_averages(frame):
+    return pd.Series([
+        rounded_average(suma_ocen, liczba_ocen) for suma_ocen, liczba_ocen in zip(frame['suma_ocen'], frame['liczba_ocen'])
+    ], index=frame.index, dtype='float64')
+
+def teacher_name(record):
+    return f"{record['imie']} {record['nazwisko']}"
+
+# Tables computed from the pairs of one cycle selection with one set of
+# parameters. The shared aggregates are computed on first use only.
+class ReportPlan:
+    def __init__(self, pairs, parameters):
+        self.pairs = pairs
+        self.parameters = parameters
+
+    # Whole classes, as if queried by id_zajec alone
+    @cached_property
+    def totals(self):
+        return self.pairs.groupby('id_zajec', dropna=False).agg(
+            uprawnieni=('uprawnieni', 'max'),
+            ilosc_odpowiedzi=('ilosc_odpowiedzi', 'sum'),
+            suma_ocen=('suma_ocen', 'sum'),
+            liczba_ocen=('liczba_ocen', 'sum')
+        ).reset_index()
+
+    # Teachers per unit they taught in, like TeacherSummary
+    @cached_property
+    def teachers(self):
+        return self.pairs.groupby(['id_osoby', 'jednostka'], dropna=False, observed=True).agg(
+            tytul=('tytul', 'max'),
+            imie=('imie', 'max'),
+            nazwisko=('nazwisko', 'max'),
+            suma_ocen=('suma_ocen', 'sum'),
+            liczba_ocen=('liczba_ocen', 'sum')
+        ).reset_index()
+
+    @cached_property
+    def subjects(self):
+        return self.pairs.groupby('nazwa_przedmiotu', dropna=False, observed=True)[
+            ['suma_ocen', 'liczba_ocen']
+        ].sum().reset_index()
+
+    # Weighted average of every teacher over all units / outside the own unit
+    @cached_property
+    def ratings_all(self):
+        return self._ratings(self.teachers)
+
+    @cached_property
+    def ratings_outside(self):
+        return self._ratings(self.teachers[REPORT_FILTERS['other_units'](self.teachers, self.parameters, {})])
+
+    @staticmethod
+    def _ratings(teachers):
+        sums = teachers.groupby('id_osoby', dropna=False)[['suma_ocen', 'liczba_ocen']].sum()
+        return dict(zip(sums.index, rounded_averages(sums)))
+
+    @staticmethod
+    def records(frame):
+        # Missing values as None, numbers as plain Python types
+        frame = frame.astype(object).where(frame.notna(), None)
+        return frame.to_dict('records')
+
+    def table(self, name, **arguments):
+        return REPORT_DEFINITIONS[name].evaluate(self, arguments)
+
+    def unique_classes(self, unit=None):
+        return self.table('unique_classes', unit=unit)
+
+    def tabela21(self):
+        return self.table('tabela21')
+
+    def tabela22(self):
+        return self.table('tabela22')
+
+    def tabela31(self):
+        return self.table('tabela31')
+
+    def tabela32(self):
+        return self.table('tabela32')
+
+    def tabela33(self):
+        return self.table('tabela33')
+
+    def tabela34(self):
+        return self.table('tabela34')
+
+    def rating_buckets(self):
+        return self.table('rating_buckets')
+
+# One report table: rows of `source` matching `where`, reduced to the distinct
+# `columns` in `order`, extended by `steps` (metrics and groupings, in order),
+# filtered by `having`, turned into output rows by `row` and shaped by `shape`.
+class ReportDefinition:
+    def __init__(self, title, source, columns, order=None, where=None, steps=(), having=None, row=None, shape=None):
+        self.title = title
+        self.source = source
+        self.columns = columns
+        self.order = order or columns
+        self.where = where
+        self.steps = steps
+        self.having = having
+        self.row = row
+        self.shape = shape
+
+    def evaluate(self, plan, arguments):
+        frame = getattr(plan, self.source)
+        if self.where:
+            frame = frame[REPORT_FILTERS[self.where](frame, plan.parameters, arguments)]
+        frame = frame[self.columns].drop_duplicates().sort_values(self.order, na_position='first', kind='stable')
+        for step in self.steps:
+            frame = REPORT_STEPS[step](frame, plan)
+        if self.having:
+            frame = frame[REPORT_FILTERS[self.having](frame, plan.parameters, arguments)]
+        rows = [self.row(record, plan.parameters) for record in plan.records(frame)]
+        return self.shape(rows, plan.parameters) if self.shape else rows
+
+REPORT_FILTERS = {
+    'own_unit': lambda frame, parameters, arguments: frame['jednostka'] == parameters['own_unit'],
+    'other_units': lambda frame, parameters, arguments: frame['jednostka'].notna() & (frame['jednostka'] != parameters['own_unit']),
+    'unit_argument': lambda frame, parameters, arguments: (
+        frame['jednostka'] == arguments['unit'] if arguments.get('unit') else pd.Series(True, index=frame.index)
+    ),
+    'low_rated': lambda frame, parameters, arguments: (
+        (frame['srednia_ocena'] < parameters['low_rating']) & (frame['ilosc_odpowiedzi'] >= parameters['min_surveys'])
+    ),
+}
+
+REPORT_STEPS = {
+    'class_totals': lambda frame, plan: frame.merge(plan.totals, on='id_zajec', how='left'),
+    'rating': lambda frame, plan: frame.assign(srednia_ocena=rounded_averages(frame)),
+    'teacher_rating': lambda frame, plan: frame.assign(srednia_ocena=frame['id_osoby'].map(plan.ratings_all)),
+    'teacher_rating_outside': lambda frame, plan: frame.assign(srednia_ocena=frame['id_osoby'].map(plan.ratings_outside)),
+    'per_teacher': lambda frame, plan: frame.groupby('id_osoby', sort=False, dropna=False).agg(
+        imie=('imie', 'first'),
+        nazwisko=('nazwisko', 'first'),
+        uprawnieni=('uprawnieni', 'sum'),
+        ilosc_odpowiedzi=('ilosc_odpowiedzi', 'sum')
+    ).reset_index(),
+}
+
+def response_rate(liczba_ankiet, liczba_uprawnionych):
+    return (liczba_ankiet / liczba_uprawnionych * 100) if liczba_uprawnionych else 0
+
+# Row of tabela31/33: response rate and the rating, which is only shown when
+# enough of the entitled students answered (min_response_rate).
+def response_row(record, parameters):
+    liczba_ankiet, liczba_uprawnionych = record['ilosc_odpowiedzi'], record['uprawnieni']
+    procent_wypelnionych = response_rate(liczba_ankiet, liczba_uprawnionych)
+    srednia_ocena = record['srednia_ocena']
+    if procent_wypelnionych < parameters['min_response_rate'] or srednia_ocena is None:
+        srednia_ocena = "-"
+    return {
+        "nauczyciel": teacher_name(record),
+        "liczba_ankiet": liczba_ankiet,
+        "liczba_uprawnionych": liczba_uprawnionych,
+        "procent_wypelnionych": round(procent_wypelnionych, 2),
+        "srednia_ocena": srednia_ocena
+    }
+
+def tabela21_row(record, parameters):
+    procent_ankiet = response_rate(record['ilosc_odpowiedzi'], record['uprawnieni'])
+    return {
+        'nazwa_przedmiotu': record['nazwa_przedmiotu'],
+        'liczba_ankiet': record['ilosc_odpowiedzi'],
+        'liczba_uprawnionych': record['uprawnieni'],
+        'procent_ankiet': round(procent_ankiet, 2),
+        'srednia_ocena': record['srednia_ocena'] if procent_ankiet >= parameters['min_response_rate'] else "-"
+    }
+
+def tabela34_row(record, parameters):
+    return {
+        "nauczyciel": f"{record['tytul']} {teacher_name(record)}" if record['tytul'] else teacher_name(record),
+        "nazwa_przedmiotu": record['nazwa_przedmiotu'],
+        "forma_zajec": record['opis_zajec'],
+        "kod_przedmiotu": record['kod_przedmiotu'],
+        "srednia_ocena": record['srednia_ocena'],
+        "liczba_ankiet": record['ilosc_odpowiedzi']
+    }
+
+def rating_or_dash(srednia_ocena):
+    return srednia_ocena if srednia_ocena is not None else "-"
+
+def tabela22_row(record, parameters):
+    return {'nazwa_przedmiotu': record['nazwa_przedmiotu'], 'srednia_ocena': rating_or_dash(record['srednia_ocena'])}
+
+def tabela32_row(record, parameters):
+    return {"nauczyciel": teacher_name(record), "srednia_ocena": rating_or_dash(record['srednia_ocena'])}
+
+def classes_by_teacher(rows, parameters):
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row.pop('nauczyciel')].append(row)
+    return [{'nauczyciel': nauczyciel, 'zajecia': zajecia} for nauczyciel, zajecia in grouped.items()]
+
+def rows_by_unit(rows, parameters):
+    grouped = {}
+    for jednostka, row in rows:
+        grouped.setdefault(jednostka, []).append(row)
+    return grouped
+
+# Number of teachers per rating range of REPORT_PARAMETERS['rating_buckets'],
+# [from, to); a range without an upper bound takes everything from `from` up.
+def count_rating_buckets(ratings, parameters):
+    buckets = parameters['rating_buckets']
+    counts = dict.fromkeys(buckets, 0)
+    for srednia_ocena in ratings:
+        if srednia_ocena is None:
+            continue
+        for name, (low, high) in buckets.items():
+            if low <= srednia_ocena and (high is None or srednia_ocena < high):
+                counts[name] += 1
+                break
+    return counts
+
+REPORT_DEFINITIONS = {
+    'unique_classes': ReportDefinition(
+        "Zajęcia nauczycieli", 'pairs', ['nazwisko', 'imie', 'id_zajec', 'jednostka', 'id_osoby', 'uprawnieni', 'ilosc_odpowiedzi'],
+        order=['nazwisko', 'imie', 'id_zajec', 'jednostka', 'id_osoby'], where='unit_argument',
+        row=lambda record, parameters: {
+            'nauczyciel': teacher_name(record), 'id_zajec': record['id_zajec'], 'uprawnieni': record['uprawnieni'],
+            'ilosc_odpowiedzi': record['ilosc_odpowiedzi'], 'jednostka': record['jednostka']
+        },
+        shape=classes_by_teacher),
+    'tabela21': ReportDefinition(
+        "Tabela 2.1", 'pairs', ['nazwa_przedmiotu', 'id_zajec'], steps=['class_totals', 'rating'], row=tabela21_row),
+    'tabela22': ReportDefinition(
+        "Tabela 2.2", 'subjects', ['nazwa_przedmiotu', 'suma_ocen', 'liczba_ocen'], order=['nazwa_przedmiotu'],
+        steps=['rating'], row=tabela22_row),
+    'tabela31': ReportDefinition(
+        "Tabela 3.1", 'pairs', ['nazwisko', 'imie', 'id_osoby', 'id_zajec'], where='own_unit',
+        steps=['class_totals', 'per_teacher', 'teacher_rating'], row=response_row),
+    'tabela32': ReportDefinition(
+        "Tabela 3.2", 'teachers', ['nazwisko', 'imie', 'id_osoby'], where='own_unit',
+        steps=['teacher_rating'], row=tabela32_row),
+    'tabela33': ReportDefinition(
+        "Tabela 3.3", 'pairs', ['nazwisko', 'imie', 'id_osoby', 'jednostka', 'id_zajec'],
+        order=['jednostka', 'nazwisko', 'imie', 'id_osoby', 'id_zajec'], where='other_units',
+        steps=['class_totals', 'teacher_rating_outside'],
+        row=lambda record, parameters: (record['jednostka'], response_row(record, parameters)),
+        shape=rows_by_unit),
+    'tabela34': ReportDefinition(
+        "Tabela 3.4", 'pairs', ['nazwisko', 'imie', 'tytul', 'nazwa_przedmiotu', 'opis_zajec', 'kod_przedmiotu', 'id_zajec'],
+        steps=['class_totals', 'rating'], having='low_rated', row=tabela34_row),
+    'rating_buckets': ReportDefinition(
+        "Analiza wyników", 'teachers', ['nazwisko', 'imie', 'id_osoby', 'jednostka'],
+        steps=['teacher_rating_outside'], row=lambda record, parameters: record['srednia_ocena'],
+        shape=count_rating_buckets),
+}
+
+report_dataset = None
+report_dataset_lock = threading.Lock()
+
+# The plan that serves the reports for the selected cycles (None: all), unit
+# (None: all) and parameters. The dataset is replaced on first use after the
+# dataset version changed (upload, clear_data, configuration) or the engine was switched.
+def report_engine(cycles=None, parameters=None, unit=None):
+    global report_dataset
+    dataset_class = FrameDataset if app.config['REPORT_ENGINE'] == 'pandas' else SummaryDataset
+    version = dataset_version()
+    with report_dataset_lock:
+        if not isinstance(report_dataset, dataset_class) or report_dataset.version != version:
+            report_dataset = dataset_class(version)
+    return report_dataset.reports(cycles, parameters, unit)
+
+
+
+# LRU cache of rendered report pages. Keys carry the dataset version, so an
+# upload or clear_data makes old entries unreachable; they are also dropped
+# explicitly to free the memory.
+class ReportCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None
+            }
+
+report_cache = ReportCache(app.config['REPORT_CACHE_SIZE'])
+
+# Identifies the data the reports are computed from: the set of uploaded files
+# plus the question/unit configuration that shapes every table.
+def dataset_version():
+    hasher = hashlib.md5()
+    for (file_hash,) in db.session.query(UploadedFile.file_hash).order_by(UploadedFile.file_hash):
+        hasher.update(file_hash.encode())
+    hasher.update(classification_fingerprint().encode())
+    return hasher.hexdigest()
+
+# Code and templates of the running deployment, hashed once at startup, so
+# pages rendered by an earlier release are not revalidated as current
+def release_fingerprint():
+    hasher = hashlib.md5()
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    templates = sorted(os.path.join(root, name) for root, _, names in os.walk(template_folder) for name in names)
+    for path in [os.path.abspath(__file__), *templates]:
+        with open(path, 'rb') as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+RELEASE_FINGERPRINT = release_fingerprint()
+
+def cached_report(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Default report parameters change the page without changing its URL
+        defaults = repr(sorted(app.config['REPORT_PARAMETERS'].items()))
+        version = hashlib.md5(f"{dataset_version()}:{RELEASE_FINGERPRINT}:{defaults}".encode()).hexdigest()
+        etag = hashlib.md5(f"{version}:{request.full_path}".encode()).hexdigest()
+
+        if etag in request.if_none_match:
+            report_cache.record_not_modified()
+            response = make_response('', 304)
+        else:
+            key = (version, request.full_path)
+            body = report_cache.get(key)
+            if body is None:
+                body = view(*args, **kwargs)
+                report_cache.put(key, body)
+            response = make_response(body)
+
+        response.set_etag(etag)
+        # Browsers must revalidate, which costs one cheap version query
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+# Background ingestion. Uploads are queued as jobs and parsed by a small thread
+# pool; each file is committed in its own transaction together with its
+# UploadedFile row. SQLite allows a single writer, so the write transactions
+# are serialised by `ingest_write_lock` (clear_data takes it as well). Parsing
+# and validation happen before the lock is taken, so workers overlap there.
+ingest_write_lock = threading.Lock()
+
+# Validated chunks of one upload, pickled to a temporary file while the job
+# parses without the write lock and read back once it holds the lock
+class ChunkSpool:
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(dir=app.config['UPLOAD_FOLDER'])
+
+    def write(self, chunk):
+        pickle.dump(chunk, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        self.file.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.file)
+            except EOFError:
+                return
+
+    def close(self):
+        self.file.close()
+
+
+class IngestJob:
+    def __init__(self, filename, file_hash, replaces=None):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.file_hash = file_hash
+        self.replaces = replaces  # UploadedFile.id swapped out by this upload
+        self.status = 'queued'
+        self.rows = 0
+        self.rejected = 0
+        self.inserted = self.updated = self.skipped = None  # known once the file is loaded
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running', 'merging')
+
+    def start(self):
+        self.status = 'running'
+        self.started = time.time()
+
+    def merge(self):
+        self.status = 'merging'
+
+    def update(self, rows):
+        self.rows = rows
+
+    def finish(self, error=None):
+        self.finished = time.time()
+        self.status = 'failed' if error else 'done'
+        self.error = str(error) if error else None
+
+    def to_dict(self):
+        seconds = ((self.finished or time.time()) - self.started) if self.started else 0
         return {
-            "error": "Nie znaleziono danych dla podanego ID zajęć" + (f" i osoby {id_osoby}" if id_osoby else "")
+            "id": self.id,
+            "filename": self.filename,
+            "replaces": self.replaces,
+            "status": self.status,
+            "rows": self.rows,
+            "rejected": self.rejected,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "skipped": self.skipped,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds) if seconds > 0 else 0,
+            "error": self.error
         }
-        
-def calculate_average_rating(nauczyciel, exclude_unit=True):
-    nazwisko, imie = parse_teacher_name(nauczyciel)
-    query = db.session.query(
-        Data.wartosc,
-        Data.odp_na_wartosc
-    ).filter(
-        Data.nazwisko == nazwisko,
-        Data.imie == imie,
-        Data.tresc_pytania.notin_(EXCLUDED_QUESTIONS)
-    )
-    
-    if exclude_unit:
-        query = query.filter(Data.jednostka != EXCLUDED_UNIT)
-    
-    data_rows = query.all()
-
-    average_grade, total_responses = calculate_weighted_average(data_rows)
-
-    return round(average_grade, 2) if average_grade is not None else None
-
-def calculate_average_for_class(id_zajec):
-    data_rows = db.session.query(
-        Data.wartosc,
-        Data.odp_na_wartosc
-    ).filter(
-        Data.id_zajec == id_zajec,
-        Data.tresc_pytania.notin_(EXCLUDED_QUESTIONS)
-    ).all()
 
-    average_grade, total_responses = calculate_weighted_average(data_rows)
 
-    class_data = class_details(id_zajec)
-    liczba_ankiet = class_data.get('ilosc_odpowiedzi', 0)
+class IngestQueue:
+    def __init__(self, max_workers, max_jobs):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, filename, file_hash, stream, replaces=None):
+        job = IngestJob(filename, file_hash, replaces)
+        with self.lock:
+            self.jobs[job.id] = job
+            finished = [key for key, other in self.jobs.items() if not other.active]
+            for key in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+                del self.jobs[key]
+        self.executor.submit(run_ingest_job, job, stream)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def all(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def busy(self):
+        return any(job.active for job in self.all())
+
+    def pending(self, file_hash, filename):
+        return any(job.active and (job.file_hash == file_hash or job.filename == filename)
+                   for job in self.all())
+
+    def replacing(self, file_id):
+        return any(job.active and job.replaces == file_id for job in self.all())
+
+
+# Loads one upload in two steps. The file is first read once, copied to
+# uploads/ on the way, validated and spooled to a temporary file together with
+# its snapshot and reject report; none of this touches the database, so other
+# jobs run alongside. Only the merge takes `ingest_write_lock`: a replacing
+# upload removes the old file's rows and loads the new ones in the same
+# transaction, then recomputes the summaries of the cycles either file touched;
+# readers see the old file until the commit.
+def run_ingest_job(job, stream):
+    with app.app_context():
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], job.filename)
+        part_path = file_path + '.part'
+        snapshot = SnapshotWriter(job.file_hash)
+        rejects = RejectWriter(job.file_hash)
+        spool = None
+        try:
+            job.start()
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            spool = ChunkSpool()
+            # Single read of the upload: the parser pulls from the spool and
+            # every block it reads is copied to uploads/ on the way. Zip
+            # archives are stored first and then read from the spool.
+            stream.seek(0)
+            with open(part_path, 'wb') as copy:
+                if job.filename.lower().endswith('.zip'):
+                    shutil.copyfileobj(stream, copy)
+                    stream.seek(0)
+                    source = stream
+                else:
+                    source = io.BufferedReader(TeeReader(stream, copy))
+                rows = 0
+                for chunk in read_csv_chunks(open_export(source, job.filename), rejects=rejects):
+                    snapshot.write(chunk)
+                    spool.write(chunk)
+                    rows += len(chunk)
+                    job.update(rows)
+            job.rejected = rejects.rows
+
+            job.merge()
+            with ingest_write_lock:
+                replaced = None
+                cycles = []
+                if job.replaces is not None:
+                    old = db.session.get(UploadedFile, job.replaces)
+                    if old is None:
+                        raise ValueError("Zastępowany plik nie istnieje w bazie danych")
+                    replaced = (old.filename, old.file_hash)
+                    cycles = delete_file_rows(db.session, old.id)
+                    db.session.delete(old)
+                    db.session.flush()  # frees the filename for the new upload
+
+                uploaded = UploadedFile(file_hash=job.file_hash, filename=job.filename)
+                db.session.add(uploaded)
+                db.session.flush()
+                stats = ingest_chunks(spool, file_id=uploaded.id, summaries=replaced is None)
+                uploaded.row_count = stats["rows"]
+                uploaded.rejected_count = rejects.rows
+                job.inserted, job.updated, job.skipped = stats["inserted"], stats["updated"], stats["skipped"]
+                if replaced is not None:
+                    classify_dimensions(db.session)
+                    cycles = sorted(set(cycles) | set(file_cycles(db.session, uploaded.id)))
+                    rebuild_cycle_summaries(db.session, cycles)
+                db.session.commit()
+                snapshot.commit()
+                rejects.commit()
+                os.replace(part_path, file_path)
+            if replaced is not None:
+                remove_stored_copies(*replaced, keep=job.filename)
+            report_cache.clear()
+            job.finish()
+        except Exception as e:
+            db.session.rollback()
+            snapshot.discard()
+            rejects.discard()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            app.logger.exception("Błąd podczas przetwarzania pliku %s", job.filename)
+            job.finish(error=e)
+        finally:
+            if spool is not None:
+                spool.close()
+            stream.close()
+
+# Deletes the CSV copy, the snapshot and the reject report of a file that left the database
+def remove_stored_copies(filename, file_hash, keep=None):
+    paths = [snapshot_path(file_hash), reject_path(file_hash)]
+    if filename != keep:
+        paths.append(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+# Removes one upload and its rows in a single transaction; only the summaries
+# of the cycles the file covered are recomputed.
+def delete_uploaded_file(uploaded):
+    filename, file_hash = uploaded.filename, uploaded.file_hash
+    with ingest_write_lock:
+        try:
+            cycles = delete_file_rows(db.session, uploaded.id)
+            rebuild_cycle_summaries(db.session, cycles)
+            db.session.delete(uploaded)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    remove_stored_copies(filename, file_hash)
+    report_cache.clear()
 
-    return round(average_grade, 2) if average_grade is not None else None, liczba_ankiet
 
-def get_filtered_teacher_data():
-    print("[DEBUG] Pobieranie danych dla tabeli 3.4")
-    classes = db.session.query(
-        Data.nazwisko,
-        Data.imie,
-        Data.tytul,  # Dodanie pola 'tytul'
-        Data.nazwa_przedmiotu,
-        Data.opis_zajec,
-        Data.jednostka,
-        Data.id_zajec,
-        Data.kod_przedmiotu
-    ).group_by(
-        Data.nazwisko,
-        Data.imie,
-        Data.tytul,  # Dodanie pola 'tytul' do grupowania
-        Data.nazwa_przedmiotu,
-        Data.opis_zajec,
-        Data.kod_przedmiotu,
-        Data.id_zajec
-    ).all()
+ingest_queue = IngestQueue(app.config['INGEST_WORKERS'], app.config['INGEST_JOBS_KEPT'])
 
-    filtered_data = []
-    for c in classes:
-        id_zajec = c.id_zajec
-        srednia_ocena, liczba_ankiet = calculate_average_for_class(id_zajec)
-
-        print(f"[DEBUG] Sprawdzanie nauczyciela: {c.imie} {c.nazwisko},przedmiot: {c.nazwa_przedmiotu} , średnia: {srednia_ocena}, liczba ankiet: {liczba_ankiet}")
-        if srednia_ocena is not None and srednia_ocena < 4.0 and liczba_ankiet >= 5:
-            nauczyciel_pewny = f"{c.tytul} {c.imie} {c.nazwisko}" if c.tytul else f"{c.imie} {c.nazwisko}"
-            filtered_data.append({
-                "nauczyciel": nauczyciel_pewny,
-                "nazwa_przedmiotu": c.nazwa_przedmiotu,
-                "forma_zajec": c.opis_zajec,
-                "kod_przedmiotu": c.kod_przedmiotu,
-                "srednia_ocena": srednia_ocena,
-                "liczba_ankiet": liczba_ankiet
-            })
-
-    print(f"[DEBUG] Filtracja zakończona, liczba nauczycieli: {len(filtered_data)}")
-    return filtered_data
-
-def calculate_average_rating_for_class(nazwa_przedmiotu):
-    data_rows = db.session.query(
-        Data.wartosc,
-        Data.odp_na_wartosc
-    ).filter(
-        Data.nazwa_przedmiotu == nazwa_przedmiotu,
-        Data.tresc_pytania.notin_(EXCLUDED_QUESTIONS)
-    ).all()
 
-    average_grade, total_responses = calculate_weighted_average(data_rows)
+# Prometheus-style histogram; bucket counts are cumulative
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-    return round(average_grade, 2) if average_grade is not None else None
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
 
-def class_details_by_name(nazwa_przedmiotu):
-    record = db.session.query(
-        Data.uprawnieni.label('uprawnieni_first'),
-        func.sum(cast(Data.odp_na_wartosc, Integer)).label('ilosc_odpowiedzi')
-    ).filter(
-        Data.nazwa_przedmiotu == nazwa_przedmiotu,
-        Data.tresc_pytania.ilike("Czy na początku%")
-    ).first()
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    DESCRIPTIONS = {
+        'ankieter_request_seconds': ('histogram', "Wall time of HTTP requests, including streamed bodies."),
+        'ankieter_template_render_seconds': ('histogram', "Time spent rendering Jinja templates."),
+        'ankieter_sql_statements_total': ('counter', "SQL statements executed, by endpoint."),
+        'ankieter_sql_seconds_total': ('counter', "Time spent in SQL statements, by endpoint."),
+        'ankieter_slow_queries_total': ('counter', "SQL statements slower than SLOW_QUERY_SECONDS."),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(float)
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            self.histograms[name, labels].observe(value)
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def render(self):
+        with self.lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        for name, (kind, description) in self.DESCRIPTIONS.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket in zip(Histogram.BUCKETS, counts):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {bucket}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics()
+# Per-thread state of the request being measured; SQL issued outside a
+# request (ingest workers, CLI commands) is attributed to "background".
+request_metrics = threading.local()
+
+
+class RequestMetrics:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+
+
+# Hooks are only registered when METRICS_ENABLED is set, so with metrics off
+# requests and queries run exactly as before.
+def install_instrumentation(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def finish_query(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        current = getattr(request_metrics, 'current', None)
+        endpoint = current.endpoint if current else 'background'
+        if current:
+            current.sql_statements += 1
+            current.sql_seconds += seconds
+        metrics.inc('ankieter_sql_statements_total', (('endpoint', endpoint),))
+        metrics.inc('ankieter_sql_seconds_total', (('endpoint', endpoint),), seconds)
+        if seconds >= app.config['SLOW_QUERY_SECONDS']:
+            metrics.inc('ankieter_slow_queries_total', (('endpoint', endpoint),))
+            app.logger.warning("Wolne zapytanie SQL (%.3fs, %s): %s %r", seconds, endpoint, statement, parameters)
+
+    @before_render_template.connect_via(app)
+    def start_render(sender, template, context, **extra):
+        request_metrics.render_start = time.perf_counter()
+
+    @template_rendered.connect_via(app)
+    def finish_render(sender, template, context, **extra):
+        start = getattr(request_metrics, 'render_start', None)
+        if start is not None:
+            metrics.observe('ankieter_template_render_seconds', (('template', template.name),), time.perf_counter() - start)
+            request_metrics.render_start = None
+
+    @app.before_request
+    def start_request():
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_metrics.current = RequestMetrics(endpoint)
+
+    @app.after_request
+    def finish_request(response):
+        current = getattr(request_metrics, 'current', None)
+        if current is None:
+            return response
+        labels = (('endpoint', current.endpoint), ('method', request.method), ('status', str(response.status_code)))
+
+        # Streamed pages keep querying until the server closes the response
+        def finish():
+            seconds = time.perf_counter() - current.start
+            metrics.observe('ankieter_request_seconds', labels, seconds)
+            app.logger.debug("%s %s %s: %.3fs, %d zapytań SQL (%.3fs)", labels[1][1], current.endpoint,
+                             labels[2][1], seconds, current.sql_statements, current.sql_seconds)
+            if getattr(request_metrics, 'current', None) is current:
+                request_metrics.current = None
+
+        response.call_on_close(finish)
+        return response
+
+
+if app.config['METRICS_ENABLED']:
+    with app.app_context():
+        install_instrumentation(db.engine)
+
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify([job.to_dict() for job in ingest_queue.all()])
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Nie znaleziono zadania"}), 404
+    return jsonify(job.to_dict())
 
-    if record:
-        return {
-            "nazwa_przedmiotu": nazwa_przedmiotu,
-            "uprawnieni": record.uprawnieni_first if record.uprawnieni_first is not None else 0,
-            "ilosc_odpowiedzi": record.ilosc_odpowiedzi if record.ilosc_odpowiedzi is not None else 0
-        }
-    else:
-        return {
-            "error": "No data found for the given class name"
-        }
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(report_cache.stats())
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not app.config['METRICS_ENABLED']:
+        return "Metryki są wyłączone (ustaw METRICS_ENABLED=1).\n", 404, {'Content-Type': 'text/plain; charset=utf-8'}
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 
 
 @app.route('/clear_data', methods=['POST'])
 def clear_data():
+    if ingest_queue.busy():
+        flash('Trwa przetwarzanie plików, spróbuj ponownie po jego zakończeniu.', 'danger')
+        return redirect(url_for('upload_file'))
     try:
-        upload_folder = app.config['UPLOAD_FOLDER']
-        for filename in os.listdir(upload_folder):
-            file_path = os.path.join(upload_folder, filename)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-
-        result = db.session.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
-        for table in result:
-            table_name = table[0]
-            if table_name != 'migrations':
-                db.session.execute(text(f"DELETE FROM {table_name}"))
-        db.session.commit()
+        for folder in (app.config['UPLOAD_FOLDER'], app.config['SNAPSHOT_FOLDER'], app.config['REJECT_FOLDER']):
+            if not os.path.isdir(folder):
+                continue
+            for filename in os.listdir(folder):
+                file_path = os.path.join(folder, filename)
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+
+        with ingest_write_lock:
+            result = db.session.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
+            for table in result:
+                table_name = table[0]
+                if table_name != 'migrations':
+                    db.session.execute(text(f"DELETE FROM {table_name}"))
+            rebuild_summaries(db.session)
+            db.session.commit()
+        report_cache.clear()
 
         flash("Wszystkie pliki i dane z bazy zostały usunięte.", 'success')
     except Exception as e:
@@ -278,10 +2097,83 @@ def clear_data():
 
 
 
+# Renders a template as a generator. Output is flushed every `buffer_size`
+# template events instead of per tiny fragment; the request context stays
+# available to the generator (and to lazy queries inside the template).
+def render_template_stream(template_name, buffer_size=100, **context):
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(buffer_size)
+    return stream_with_context(stream)
+
+# Column filters of the /data browser: query parameter -> criterion on Data.
+# Names are resolved to dimension ids first so the Data indexes can be used.
+DATA_FILTERS = {
+    'cykl': lambda value: Data.cykl_dydaktyczny == value,
+    'jednostka': lambda value: Data.unit_id.in_(select(Unit.id).where(Unit.jednostka == value)),
+    'id_osoby': lambda value: Data.id_osoby == (int(value) if value.isdigit() else value),
+    'przedmiot': lambda value: Data.subject_id.in_(select(Subject.id).where(Subject.nazwa_przedmiotu == value)),
+}
+
+# Data rows with the export's columns, in export order
+def flat_data_query():
+    columns = [Data.id]
+    for attr, _ in CSV_COLUMNS.values():
+        model = next(model for model in (Data, *SURROGATE_DIMENSIONS, *NATURAL_DIMENSIONS)
+                     if attr in model.__mapper__.c)
+        columns.append(getattr(model, attr))
+    return joined_data(*columns)
+
+def data_filters(args):
+    return {name: args.get(name) for name in DATA_FILTERS if args.get(name)}
+
+def filtered_data_query(filters):
+    query = flat_data_query()
+    for name, value in filters.items():
+        query = query.where(DATA_FILTERS[name](value))
+    return query
+
+# One keyset page of Data rows (id > after), yielded lazily while the template
+# streams. One extra row is fetched to know whether a next page exists.
+class DataPage:
+    def __init__(self, query, limit):
+        self.query = query
+        self.limit = limit
+        self.last_id = None
+        self.has_next = False
+
+    def __iter__(self):
+        rows = db.session.execute(self.query.limit(self.limit + 1).execution_options(yield_per=500))
+        for count, entry in enumerate(rows):
+            if count == self.limit:
+                self.has_next = True
+                break
+            self.last_id = entry.id
+            yield entry
+
 @app.route('/data')
 def view_data():
-    data_entries = Data.query.all()
-    return render_template('data.html', data_entries=data_entries)
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', app.config['DATA_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['DATA_PAGE_SIZE_MAX']))
+
+    filters = data_filters(request.args)
+    page = DataPage(filtered_data_query(filters).where(Data.id > after).order_by(Data.id), limit)
+    options = {
+        'cykle': known_cycles(),
+        'jednostki': [jednostka for (jednostka,) in db.session.query(UnitSummary.jednostka).distinct().order_by(UnitSummary.jednostka)],
+        'przedmioty': [nazwa for (nazwa,) in db.session.query(SubjectSummary.nazwa_przedmiotu).distinct().order_by(SubjectSummary.nazwa_przedmiotu)],
+        'nauczyciele': db.session.query(
+            TeacherSummary.id_osoby, TeacherSummary.imie, TeacherSummary.nazwisko
+        ).distinct().order_by(TeacherSummary.nazwisko, TeacherSummary.imie).all()
+    }
+
+    # Rows are rendered while they are read, so memory use does not depend on
+    # the size of the table and the first bytes go out immediately.
+    return app.response_class(
+        render_template_stream('data.html', data_entries=page, page=page, filters=filters, limit=limit, options=options),
+        mimetype='text/html'
+    )
 
 
 
@@ -292,399 +2184,463 @@ def upload_file():
             flash('Brak pliku w żądaniu')
             return redirect(request.url)
 
-        file = request.files['file']
-        if file.filename == '':
+        files = [file for file in request.files.getlist('file') if file.filename]
+        if not files:
             flash('Nie wybrano pliku')
             return redirect(request.url)
 
-        if file and allowed_file(file.filename):
-            if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                os.makedirs(app.config['UPLOAD_FOLDER'])
-
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-            file.save(file_path)
-
-            file_hash = calculate_file_hash(file_path)
-
-            existing_file = UploadedFile.query.filter_by(file_hash=file_hash).first()
-            if existing_file:
-                os.remove(file_path)
-                flash('Ten plik już istnieje w bazie danych.')
-                return redirect(request.url)
+        for file in files:
+            queue_upload(file)
+        return redirect(url_for('upload_file'))
+
+    files = UploadedFile.query.order_by(UploadedFile.id).all()
+    return render_template('upload.html', files=files)
+
+# Validates one uploaded file and hands it to the ingest queue, optionally as
+# the replacement of an uploaded file (which may have the same name)
+def queue_upload(file, replaces=None):
+    if not allowed_file(file.filename):
+        flash(f'Niedozwolony typ pliku: {file.filename}')
+        return None
+
+    # Duplicates are rejected before anything touches uploads/ or the parser
+    file_hash = calculate_file_hash(file.stream)
+    filename = secure_filename(file.filename)
+    existing_files = UploadedFile.query.filter(
+        (UploadedFile.file_hash == file_hash) | (UploadedFile.filename == filename)
+    ).all()
+    if replaces is not None:
+        # The replaced file may share the name, but not the content
+        existing_files = [f for f in existing_files if f.id != replaces.id or f.file_hash == file_hash]
+    if existing_files or ingest_queue.pending(file_hash, filename):
+        flash(f'Ten plik już istnieje w bazie danych: {file.filename}')
+        return None
+
+    # The spool is handed over to the worker; the request must not close it
+    stream, file.stream = file.stream, io.BytesIO()
+    job = ingest_queue.submit(filename, file_hash, stream, replaces.id if replaces is not None else None)
+    if replaces is not None:
+        flash(f'Plik {filename} zastąpi plik {replaces.filename} po przetworzeniu.')
+    else:
+        flash(f'Plik {filename} został dodany do kolejki przetwarzania.')
+    return job
+
+
+@app.route('/files')
+def list_files():
+    return jsonify([
+        {"id": uploaded.id, "filename": uploaded.filename, "file_hash": uploaded.file_hash, "rows": uploaded.row_count,
+         "rejected": uploaded.rejected_count}
+        for uploaded in UploadedFile.query.order_by(UploadedFile.id)
+    ])
+
+
+@app.route('/files/<int:file_id>/delete', methods=['POST'])
+def delete_file(file_id):
+    uploaded = db.get_or_404(UploadedFile, file_id)
+    if ingest_queue.busy():
+        flash('Trwa przetwarzanie plików, spróbuj ponownie po jego zakończeniu.', 'danger')
+        return redirect(url_for('upload_file'))
+    if untracked_rows(db.session):
+        flash(UNTRACKED_ROWS_MESSAGE, 'danger')
+        return redirect(url_for('upload_file'))
+    filename = uploaded.filename
+    try:
+        started = time.perf_counter()
+        delete_uploaded_file(uploaded)
+        flash(f'Usunięto plik {filename} i jego dane ({time.perf_counter() - started:.2f}s).', 'success')
+    except Exception as e:
+        flash(f'Błąd podczas usuwania pliku {filename}: {e}', 'danger')
+    return redirect(url_for('upload_file'))
 
-            new_file = UploadedFile(file_hash=file_hash, filename=filename)
-            db.session.add(new_file)
-            db.session.commit()
 
-            try:
-                df = pd.read_csv(file_path, delimiter=';', encoding='utf-8')
-                for _, row in df.iterrows():
-                    data_entry = Data(
-                        cykl_dydaktyczny=row['cykl dydaktyczny'],
-                        kod_przedmiotu=row['kod przedmiotu'],
-                        nazwa_przedmiotu=row['nazwa przedmiotu'],
-                        jezyk_prowadzenia_przedmiotu=row['język prowadzenia przedmiotu'],
-                        id_zajec=row['id zajęć'],
-                        kod_zajec=row['kod zajęć'],
-                        opis_zajec=row['opis zajęć'],
-                        nr_grupy=row['nr grupy'],
-                        id_osoby=row['id osoby'],
-                        tytul=row['tytul'],
-                        imie=row['imie'],
-                        nazwisko=row['nazwisko'],
-                        kod_jednostki=row['kod jednostki'],
-                        jednostka=row['jednostka'],
-                        id_pytania=row['id pytania'],
-                        kolejnosc=row['kolejność'],
-                        tresc_pytania=row['treść pytania'],
-                        wartosc=row['wartość'],
-                        opis_odpowiedzi_pl=row['opis odpowiedzi (PL)'],
-                        opis_odpowiedzi_en=row['opis odpowiedzi (EN)'],
-                        odp_na_wartosc=row['odp_na_wartosc'],
-                        odp_na_pytanie=row['odp_na_pytanie'],
-                        udzial_wart_w_pytaniu=row['udzial_wart_w_pytaniu'],
-                        uprawnieni=row['uprawnieni'],
-                        udzial_wartosci_w_uprawnionych=row['udzial_wartosci_w_uprawnionych']
-                    )
-                    db.session.add(data_entry)
+@app.route('/files/<int:file_id>/replace', methods=['POST'])
+def replace_file(file_id):
+    uploaded = db.get_or_404(UploadedFile, file_id)
+    file = request.files.get('file')
+    if file is None or not file.filename:
+        flash('Nie wybrano pliku')
+    elif untracked_rows(db.session):
+        flash(UNTRACKED_ROWS_MESSAGE, 'danger')
+    elif ingest_queue.replacing(file_id):
+        flash(f'Plik {uploaded.filename} jest już zastępowany.')
+    else:
+        queue_upload(file, replaces=uploaded)
+    return redirect(url_for('upload_file'))
 
-                db.session.commit()
-                flash('Plik został pomyślnie przesłany i przetworzony')
-            except Exception as e:
-                db.session.rollback()
-                flash(f'Wystąpił błąd podczas przetwarzania pliku: {e}')
-            return redirect(url_for('upload_file'))
 
-    return render_template('upload.html')
+@app.route('/files/<int:file_id>/rejects.csv')
+def file_rejects(file_id):
+    uploaded = db.get_or_404(UploadedFile, file_id)
+    path = reject_path(uploaded.file_hash)
+    if not os.path.exists(path):
+        return "Brak odrzuconych wierszy dla tego pliku", 404
+    return send_file(os.path.abspath(path), mimetype='text/csv', as_attachment=True,
+                     download_name=f"odrzucone-{uploaded.filename.split('.')[0]}.csv")
 
 
 
 @app.route('/unique_classes')
+@cached_report
 def unique_classes_details():
-    unit_filter = request.args.get('unit', None)
-
-    # Dodajemy Data.id_osoby do zapytania
-    query = db.session.query(
-        Data.imie,
-        Data.nazwisko,
-        Data.id_zajec,
-        Data.jednostka,
-        Data.id_osoby  # Nowy parametr
-    ).group_by(
-        Data.nazwisko,
-        Data.imie,
-        Data.id_zajec,
-        Data.jednostka,
-        Data.id_osoby  # Grupowanie po id_osoby
-    )
-
-    if unit_filter:
-        query = query.filter(Data.jednostka == unit_filter)
-
-    records = query.all()
-
-    grouped_data = defaultdict(list)
-    for row in records:
-        nauczyciel = f"{row.imie} {row.nazwisko}"
-        id_zajec = row.id_zajec
-        id_osoby = row.id_osoby  # Pobieramy id_osoby
+    unit_filter = selected_unit(request.args)
+    cycles = selected_cycles(request.args)
+    tabela_details = report_engine(cycles, report_parameters(request.args), unit_filter).unique_classes(unit_filter)
 
-        # Przekazujemy oba parametry do class_details
-        data = class_details(id_zajec, id_osoby)
-        if 'error' in data:
-            # Opcjonalnie: obsłuż błędy, np. pomiń ten rekord
-            continue
-
-        liczba_uprawnionych = data.get('uprawnieni', 0)
-        liczba_odpowiedzi = data.get('ilosc_odpowiedzi', 0)
-
-        grouped_data[nauczyciel].append({
-            'id_zajec': id_zajec,
-            'uprawnieni': liczba_uprawnionych,
-            'ilosc_odpowiedzi': liczba_odpowiedzi,
-            'jednostka': row.jednostka
-        })
-
-    tabela_details = [
-        {
-            'nauczyciel': nauczyciel,
-            'zajecia': zajecia
-        }
-        for nauczyciel, zajecia in grouped_data.items()
-    ]
-
-    return render_template('unique_classes.html', tabela_details=tabela_details)
+    return render_template('unique_classes.html', tabela_details=tabela_details, cycle_filter=cycle_filter(cycles))
 
 
 
 @app.route('/tabela31')
+@cached_report
 def tabela31():
-    teachers = db.session.query(
-        Data.nazwisko,
-        Data.imie,
-        Data.id_zajec
-    ).filter(
-        Data.jednostka == "Wydział Nauk Społecznych"
-    ).group_by(
-        Data.nazwisko,
-        Data.imie,
-        Data.id_zajec
-    ).all()
-
-    teacher_data = {}
-    for teacher in teachers:
-        nauczyciel = f"{teacher.imie} {teacher.nazwisko}"
-        if nauczyciel not in teacher_data:
-            teacher_data[nauczyciel] = []
-        teacher_data[nauczyciel].append(teacher.id_zajec)
-
-    tabela_dane = []
-    for nauczyciel, zajecia_ids in teacher_data.items():
-        total_uprawnieni = 0
-        total_odpowiedzi = 0
-
-        for id_zajec in zajecia_ids:
-            data = class_details(id_zajec)
-
-            total_uprawnieni += data.get("uprawnieni", 0)
-            total_odpowiedzi += data.get("ilosc_odpowiedzi", 0)
-
-        procent_wypelnionych = (total_odpowiedzi / total_uprawnieni * 100) if total_uprawnieni else 0
-
-        if procent_wypelnionych < 25:
-            srednia_ocena = "-"
-        else:
-            # Przekazujemy exclude_unit=False, aby uwzględnić jednostkę "Wydział Nauk Społecznych"
-            srednia_ocena = calculate_average_rating(nauczyciel, exclude_unit=False)
-
-            # Dodatkowo, jeśli nadal zwraca None, ustawiamy "-"
-            if srednia_ocena is None:
-                srednia_ocena = "-"
+    cycles = selected_cycles(request.args)
+    parameters = report_parameters(request.args)
+    tabela_dane = report_engine(cycles, parameters, selected_unit(request.args)).tabela31()
 
-        tabela_dane.append({
-            "nauczyciel": nauczyciel,
-            "liczba_ankiet": total_odpowiedzi,
-            "liczba_uprawnionych": total_uprawnieni,
-            "procent_wypelnionych": round(procent_wypelnionych, 2),
-            "srednia_ocena": srednia_ocena
-        })
-
-    return render_template('tabela31.html', tabela_dane=tabela_dane)
+    return render_template('tabela31.html', tabela_dane=tabela_dane, parametry=parameters, cycle_filter=cycle_filter(cycles))
 
 
 
 @app.route('/tabela32')
+@cached_report
 def tabela32():
-    teachers = db.session.query(
-        Data.nazwisko,
-        Data.imie
-    ).filter(
-        Data.jednostka == "Wydział Nauk Społecznych"
-    ).group_by(
-        Data.nazwisko,
-        Data.imie
-    ).order_by(
-        Data.nazwisko, Data.imie
-    ).all()
+    cycles = selected_cycles(request.args)
+    parameters = report_parameters(request.args)
+    tabela_dane = report_engine(cycles, parameters, selected_unit(request.args)).tabela32()
 
-    tabela_dane = []
-    for teacher in teachers:
-        nauczyciel = f"{teacher.imie} {teacher.nazwisko}"
-        # Przekazujemy exclude_unit=False, aby uwzględnić "Wydział Nauk Społecznych"
-        srednia_ocena = calculate_average_rating(nauczyciel, exclude_unit=False)
-        tabela_dane.append({
-            "nauczyciel": nauczyciel,
-            "srednia_ocena": srednia_ocena if srednia_ocena is not None else "-"
-        })
-
-    return render_template('tabela32.html', tabela_dane=tabela_dane)
+    return render_template('tabela32.html', tabela_dane=tabela_dane, parametry=parameters, cycle_filter=cycle_filter(cycles))
 
 
 @app.route('/tabela33')
+@cached_report
 def tabela33():
-    teachers = db.session.query(
-        Data.nazwisko,
-        Data.imie,
-        Data.jednostka,
-        Data.id_zajec
-    ).filter(
-        Data.jednostka != "Wydział Nauk Społecznych"
-    ).group_by(
-        Data.nazwisko,
-        Data.imie,
-        Data.jednostka,
-        Data.id_zajec
-    ).order_by(
-        Data.jednostka, Data.nazwisko, Data.imie
-    ).all()
+    cycles = selected_cycles(request.args)
+    parameters = report_parameters(request.args)
+    tabela_dane = report_engine(cycles, parameters, selected_unit(request.args)).tabela33()
 
-    tabela_dane = {}
+    # Średnia ważona liczbą ankiet, tylko z wierszy z oceną (co najmniej min_response_rate% wypełnionych ankiet)
     sum_weighted_avg = 0
     sum_weights = 0
-
-    for teacher in teachers:
-        nauczyciel = f"{teacher.imie} {teacher.nazwisko}"
-        jednostka = teacher.jednostka
-        id_zajec = teacher.id_zajec
-
-        data = class_details(id_zajec)
-        if "error" in data:
-            continue
-
-        liczba_uprawnionych = data.get("uprawnieni", 0)
-        liczba_ankiet = data.get("ilosc_odpowiedzi", 0)
-
-        # Obliczenie procentu wypełnionych ankiet
-        procent_wypelnionych = (liczba_ankiet / liczba_uprawnionych * 100) if liczba_uprawnionych else 0
-
-        # Sprawdzenie, czy procent wypełnionych ankiet jest wystarczający (minimum 25%)
-        if procent_wypelnionych < 25:
-            srednia_ocena = "-"
-        else:
-            srednia_ocena = calculate_average_rating(nauczyciel)
-            # Jeśli calculate_average_rating zwróci None, ustaw "-"
-            if srednia_ocena is None:
-                srednia_ocena = "-"
-
-        if jednostka not in tabela_dane:
-            tabela_dane[jednostka] = []
-
-        tabela_dane[jednostka].append({
-            "nauczyciel": nauczyciel,
-            "liczba_ankiet": liczba_ankiet,
-            "liczba_uprawnionych": liczba_uprawnionych,
-            "procent_wypelnionych": round(procent_wypelnionych, 2),
-            "srednia_ocena": srednia_ocena
-        })
-
-        # Dodawanie do sumy tylko, jeśli procent wypełnionych ankiet jest >= 25% i srednia_ocena nie jest "-"
-        if srednia_ocena != "-" and procent_wypelnionych >= 25:
-            sum_weighted_avg += srednia_ocena * liczba_ankiet
-            sum_weights += liczba_ankiet
+    for nauczyciele in tabela_dane.values():
+        for row in nauczyciele:
+            if row["srednia_ocena"] != "-" and row["procent_wypelnionych"] >= parameters['min_response_rate']:
+                sum_weighted_avg += row["srednia_ocena"] * row["liczba_ankiet"]
+                sum_weights += row["liczba_ankiet"]
 
     ogolna_srednia_wazona = round(sum_weighted_avg / sum_weights, 2) if sum_weights > 0 else "-"
 
-    return render_template('tabela33.html', tabela_dane=tabela_dane, ogolna_srednia_wazona=ogolna_srednia_wazona)
+    return render_template('tabela33.html', tabela_dane=tabela_dane, ogolna_srednia_wazona=ogolna_srednia_wazona, parametry=parameters,
+                           cycle_filter=cycle_filter(cycles))
 
 
 
 @app.route('/tabela34')
+@cached_report
 def tabela34():
-    filtered_data = get_filtered_teacher_data()
+    cycles = selected_cycles(request.args)
+    parameters = report_parameters(request.args)
+    filtered_data = report_engine(cycles, parameters, selected_unit(request.args)).tabela34()
 
-    return render_template('tabela34.html', tabela_dane=filtered_data)
+    return render_template('tabela34.html', tabela_dane=filtered_data, parametry=parameters, cycle_filter=cycle_filter(cycles))
 
 
 
 @app.route('/tabela21')
+@cached_report
 def tabela21():
-    per_class_data = db.session.query(
-        Data.nazwa_przedmiotu,
-        Data.id_zajec
-    ).group_by(
-        Data.nazwa_przedmiotu,
-        Data.id_zajec
-    ).all()
-
-    tabela21 = []
-    for row in per_class_data:
-        nazwa_przedmiotu = row.nazwa_przedmiotu
-        id_zajec = row.id_zajec
-
-        class_data = class_details(id_zajec)
-        liczba_uprawnionych = class_data.get('uprawnieni', 0)
-        liczba_ankiet = class_data.get('ilosc_odpowiedzi', 0)
-        procent_ankiet = (liczba_ankiet / liczba_uprawnionych * 100) if liczba_uprawnionych else 0
-
-        srednia_ocena, _ = calculate_average_for_class(id_zajec)
-        srednia_ocena = srednia_ocena if procent_ankiet >= 25 else "-"
+    cycles = selected_cycles(request.args)
+    tabela21 = report_engine(cycles, report_parameters(request.args), selected_unit(request.args)).tabela21()
 
-        tabela21.append({
-            'nazwa_przedmiotu': nazwa_przedmiotu,
-            'liczba_ankiet': liczba_ankiet,
-            'liczba_uprawnionych': liczba_uprawnionych,
-            'procent_ankiet': round(procent_ankiet, 2),
-            'srednia_ocena': srednia_ocena
-        })
-
-    tabela21 = sorted(tabela21, key=lambda x: x['nazwa_przedmiotu'])
-
-    return render_template('tabela21.html', tabela21=tabela21)
+    return render_template('tabela21.html', tabela21=tabela21, cycle_filter=cycle_filter(cycles))
 
 
 
 @app.route('/tabela22')
+@cached_report
 def tabela22():
-    subjects = db.session.query(
-        Data.nazwa_przedmiotu
-    ).group_by(
-        Data.nazwa_przedmiotu
-    ).all()
+    cycles = selected_cycles(request.args)
+    tabela22 = report_engine(cycles, report_parameters(request.args), selected_unit(request.args)).tabela22()
 
-    tabela22 = []
-    for subject in subjects:
-        nazwa_przedmiotu = subject.nazwa_przedmiotu
-        srednia_ocena = calculate_average_rating_for_class(nazwa_przedmiotu)
-        tabela22.append({
-            'nazwa_przedmiotu': nazwa_przedmiotu,
-            'srednia_ocena': srednia_ocena if srednia_ocena is not None else "-"
-        })
+    return render_template('tabela22.html', tabela22=tabela22, cycle_filter=cycle_filter(cycles))
 
-    return render_template('tabela22.html', tabela22=tabela22)
 
 
+GRADE_WORDS = {2: 'niedostatecznie', 3: 'dostatecznie', 4: 'dobrze', 5: 'bardzo dobrze'}
 
 @app.route('/analiza_wynikow')
+@cached_report
 def analiza_wynikow():
-    wyniki = db.session.query(
-        Data.nazwisko,
-        Data.imie,
-        Data.jednostka
-    ).group_by(
-        Data.nazwisko,
-        Data.imie,
-        Data.jednostka
-    ).all()
+    cycles = selected_cycles(request.args)
+    parameters = report_parameters(request.args)
+    opis = report_engine(cycles, parameters, selected_unit(request.args)).rating_buckets()
 
-    opis = {
-        'srednie_2_3': 0,
-        'srednie_3_4': 0,
-        'srednie_4_5': 0,
-        'srednie_5': 0
-    }
+    total_nauczycieli = sum(opis.values())
+    opis_procentowy = {k: (v / total_nauczycieli * 100) if total_nauczycieli else 0 for k, v in opis.items()}
 
-    for wynik in wyniki:
-        nauczyciel = f"{wynik.imie} {wynik.nazwisko}"
-        srednia_ocena = calculate_average_rating(nauczyciel)
+    # Jedna fraza na przedział ocen z parametrów, np. "4,0 - 5,0" albo "5,0" dla przedziału bez górnej granicy
+    przedzialy = [
+        f"{round(opis_procentowy[k], 2)}% {'uzyskało ' if i == 0 else ''}ocenę średnią "
+        + (f"{low:.1f} - {high:.1f}" if high is not None else f"{low:.1f}").replace('.', ',')
+        for i, (k, (low, high)) in enumerate(parameters['rating_buckets'].items())
+    ]
+    # Ocena słowna według przedziału z największą liczbą nauczycieli i jego górnej granicy
+    najliczniejszy, (low, high) = max(parameters['rating_buckets'].items(), key=lambda bucket: opis[bucket[0]])
+    ocena = GRADE_WORDS[min(5, max(2, math.floor(high if high is not None else low)))]
+    if opis_procentowy[najliczniejszy] > 50:
+        werdykt = f"Większość nauczycieli spoza jednostki {parameters['own_unit']} została oceniona {ocena}"
+    else:
+        werdykt = f"Najwięcej nauczycieli spoza jednostki {parameters['own_unit']} zostało ocenionych {ocena}"
+    wymienione = ' oraz '.join(filter(None, [', '.join(przedzialy[:-1]), przedzialy[-1]]))
+    opis_text = f"{werdykt}, tj. {wymienione}."
+
+    return render_template('analiza_wynikow.html', opis=opis_text, parametry=parameters, cycle_filter=cycle_filter(cycles))
+
+
+
+# Exports: the report tables as flat rows, computed by the same engine methods
+# as the HTML pages. name -> (columns, rows(reports, args))
+def unique_classes_rows(reports, args):
+    for teacher in reports.unique_classes(args.get('unit')):
+        for zajecia in teacher['zajecia']:
+            yield {'nauczyciel': teacher['nauczyciel'], **zajecia}
+
+def tabela33_rows(reports, args):
+    for jednostka, rows in reports.tabela33().items():
+        for row in rows:
+            yield {'jednostka': jednostka, **row}
+
+RESPONSE_COLUMNS = ['nauczyciel', 'liczba_ankiet', 'liczba_uprawnionych', 'procent_wypelnionych', 'srednia_ocena']
+
+REPORT_EXPORTS = {
+    'unique_classes': (['nauczyciel', 'id_zajec', 'jednostka', 'uprawnieni', 'ilosc_odpowiedzi'], unique_classes_rows),
+    'tabela21': (['nazwa_przedmiotu', 'liczba_ankiet', 'liczba_uprawnionych', 'procent_ankiet', 'srednia_ocena'],
+                 lambda reports, args: reports.tabela21()),
+    'tabela22': (['nazwa_przedmiotu', 'srednia_ocena'], lambda reports, args: reports.tabela22()),
+    'tabela31': (RESPONSE_COLUMNS, lambda reports, args: reports.tabela31()),
+    'tabela32': (['nauczyciel', 'srednia_ocena'], lambda reports, args: reports.tabela32()),
+    'tabela33': (['jednostka', *RESPONSE_COLUMNS], tabela33_rows),
+    'tabela34': (['nauczyciel', 'nazwa_przedmiotu', 'forma_zajec', 'kod_przedmiotu', 'srednia_ocena', 'liczba_ankiet'],
+                 lambda reports, args: reports.tabela34()),
+}
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+EXPORT_BATCH_ROWS = 1000  # Rows encoded per chunk of the response
+XLSX_SHEET_ROWS = 1000000  # Excel allows 1048576 rows per sheet
+
+# "-" marks a missing rating in the HTML tables; exports leave the cell empty
+def export_value(value):
+    return None if isinstance(value, str) and value == "-" else value
+
+def json_default(value):
+    return value.item() if hasattr(value, 'item') else str(value)
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def csv_chunks(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in batched(rows, EXPORT_BATCH_ROWS):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def jsonl_chunks(columns, rows):
+    for batch in batched(rows, EXPORT_BATCH_ROWS):
+        yield ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=json_default) + '\n'
+                      for row in batch)
+
+# openpyxl's write-only mode streams the rows to a temporary file; the finished
+# workbook (a zip archive) is then sent in chunks.
+def xlsx_chunks(columns, rows, title='raport'):
+    workbook = Workbook(write_only=True)
+    sheet = None
+    for count, row in enumerate(rows):
+        if count % XLSX_SHEET_ROWS == 0:
+            sheet = workbook.create_sheet(f"{title[:25]} {count // XLSX_SHEET_ROWS + 1}" if count else title[:31])
+            sheet.append(columns)
+        sheet.append(row)
+    if sheet is None:
+        workbook.create_sheet(title[:31]).append(columns)
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        yield from iter(lambda: output.read(64 * 1024), b'')
+
+EXPORT_WRITERS = {'csv': csv_chunks, 'jsonl': jsonl_chunks}
+
+# Every report table on one page. All of them come from the same plan, so the
+# pairs are read once for the whole page.
+@app.route('/dashboard')
+@cached_report
+def dashboard():
+    cycles = selected_cycles(request.args)
+    reports = report_engine(cycles, report_parameters(request.args), selected_unit(request.args))
+    tabele = [
+        (name, REPORT_DEFINITIONS[name].title, columns, list(report_rows(reports, request.args)))
+        for name, (columns, report_rows) in REPORT_EXPORTS.items()
+    ]
 
-        if srednia_ocena is None:
-            continue
+    return render_template('dashboard.html', tabele=tabele, cycle_filter=cycle_filter(cycles))
 
-        if 2.0 <= srednia_ocena < 3.0:
-            opis['srednie_2_3'] += 1
-        elif 3.0 <= srednia_ocena < 4.0:
-            opis['srednie_3_4'] += 1
-        elif 4.0 <= srednia_ocena < 5.0:
-            opis['srednie_4_5'] += 1
-        elif srednia_ocena == 5.0:
-            opis['srednie_5'] += 1
+@app.route('/export/<name>.<any(csv, jsonl, xlsx):fmt>')
+def export_report(name, fmt):
+    if name != 'data' and name not in REPORT_EXPORTS:
+        return "Nieznany raport", 404
+    if fmt == 'xlsx' and Workbook is None:
+        return "Eksport XLSX wymaga biblioteki openpyxl", 404
 
-    total_nauczycieli = sum(opis.values())
-    opis_procentowy = {k: (v / total_nauczycieli * 100) if total_nauczycieli else 0 for k, v in opis.items()}
+    if name == 'data':
+        columns = ['id', *CSV_COLUMNS]
+        query = filtered_data_query(data_filters(request.args)).order_by(Data.id)
+        rows = (tuple(entry) for entry in db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_ROWS)))
+    else:
+        columns, report_rows = REPORT_EXPORTS[name]
+        reports = report_engine(selected_cycles(request.args), report_parameters(request.args), selected_unit(request.args))
+        rows = ([export_value(row[column]) for column in columns] for row in report_rows(reports, request.args))
+
+    chunks = xlsx_chunks(columns, rows, name) if fmt == 'xlsx' else EXPORT_WRITERS[fmt](columns, rows)
+    # No length is known up front, so the response goes out with chunked encoding
+    response = app.response_class(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+    return response
 
-    opis_text = (
-        f"Większość nauczycieli z Instytutów Wydziału Nauk Społecznych została oceniona "
-        f"{'dobrze' if opis_procentowy['srednie_3_4'] > 50 else 'bardzo dobrze'}, "
-        f"tj. {round(opis_procentowy['srednie_2_3'], 2)}% uzyskało ocenę średnią 2,0 - 3,0, "
-        f"{round(opis_procentowy['srednie_3_4'], 2)}% ocenę średnią 3,0 - 4,0, "
-        f"{round(opis_procentowy['srednie_4_5'], 2)}% ocenę średnią 4,0 - 5,0 oraz "
-        f"{round(opis_procentowy['srednie_5'], 2)}% ocenę średnią 5,0."
-    )
 
-    return render_template('analiza_wynikow.html', opis=opis_text)
 
+REPORT_ROUTES = [
+    '/unique_classes', '/tabela21', '/tabela22', '/tabela31', '/tabela32', '/tabela33', '/tabela34', '/analiza_wynikow',
+    '/dashboard'
+]
+
+# Offline prebuild: every report page as static HTML and every table as JSON,
+# once for all units and once per unit, written to one directory per scope.
+# Scopes are computed in parallel by a process pool; each process reads the
+# database on its own connection and renders with its own report engine.
+def report_units(cycles=None):
+    query = select(ClassSummary.jednostka).distinct().where(
+        ClassSummary.jednostka.isnot(None),
+        *cycle_criteria(ClassSummary, cycles)
+    ).order_by(ClassSummary.jednostka)
+    return db.session.execute(query).scalars().all()
+
+def prebuild_unit(unit, directory, args):
+    start = time.perf_counter()
+    query = [*args, *([('unit', unit)] if unit else [])]
+    os.makedirs(directory, exist_ok=True)
+    client = app.test_client()
+    for route in REPORT_ROUTES:
+        response = client.get(route, query_string=query)
+        if response.status_code != 200:
+            raise RuntimeError(f"{route} ({unit or 'wszystkie jednostki'}) zwrócił kod {response.status_code}")
+        with open(os.path.join(directory, route.strip('/') + '.html'), 'wb') as f:
+            f.write(response.get_data())
+
+    with app.test_request_context(query_string=query):
+        reports = report_engine(selected_cycles(request.args), report_parameters(request.args), selected_unit(request.args))
+        tables = {
+            name: [{column: export_value(row[column]) for column in columns} for row in report_rows(reports, request.args)]
+            for name, (columns, report_rows) in REPORT_EXPORTS.items()
+        }
+        tables['rating_buckets'] = reports.rating_buckets()
+    for name, rows in tables.items():
+        with open(os.path.join(directory, name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, default=json_default)
+    return time.perf_counter() - start
+
+def prebuild_reports(output, workers=None, cycles=None):
+    args = [('cykl', cykl) for cykl in cycles or []]
+    units = report_units(cycles)
+    scopes = [(None, 'wszystkie')] + [
+        (unit, f"{number:03d}-{secure_filename(unit) or 'jednostka'}") for number, unit in enumerate(units, 1)
+    ]
+    # Pooled SQLite connections must not be shared with the forked processes
+    db.session.remove()
+    db.engine.dispose()
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            name: pool.submit(prebuild_unit, unit, os.path.join(output, name), args) for unit, name in scopes
+        }
+        seconds = {name: future.result() for name, future in futures.items()}
+    manifest = {
+        'cykle': cycles,
+        'wersja_danych': dataset_version(),
+        'sekundy': round(time.perf_counter() - start, 3),
+        'jednostki': [
+            {'jednostka': unit, 'katalog': name, 'sekundy': round(seconds[name], 3)} for unit, name in scopes
+        ]
+    }
+    with open(os.path.join(output, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+@app.cli.command('prebuild-reports')
+@click.option('--output', default='prebuilt', show_default=True, type=click.Path(file_okay=False))
+@click.option('--workers', type=int, help="Processes in the pool; defaults to the number of CPUs.")
+@click.option('--cykl', 'cycles', multiple=True, help="Teaching cycle to include; may be repeated. All cycles by default.")
+def prebuild_reports_command(output, workers, cycles):
+    """Write every report as static HTML and JSON, for all units and per unit."""
+    manifest = prebuild_reports(output, workers, list(cycles) or None)
+    for scope in sorted(manifest['jednostki'], key=lambda scope: -scope['sekundy']):
+        click.echo(f"{scope['sekundy']:>9.3f} s  {scope['jednostka'] or 'wszystkie jednostki'}")
+    total = sum(scope['sekundy'] for scope in manifest['jednostki'])
+    click.echo(f"{len(manifest['jednostki'])} zakresów w {manifest['sekundy']:.3f} s (suma czasów jednostek {total:.3f} s), "
+               f"wyniki w {output}/")
+
+# Reloads Data, its dimensions and the summaries from the stored uploads:
+# Parquet snapshots where present, otherwise the CSV copy in uploads/ (which
+# then gets its snapshot written). Used after schema changes.
+def rebuild_database():
+    with ingest_write_lock:
+        for model in (ClassSummary, TeacherSummary, SubjectSummary, UnitSummary, DataFile, Data, *SURROGATE_DIMENSIONS, *NATURAL_DIMENSIONS):
+            db.session.execute(model.__table__.delete())
+
+        snapshots = []
+        try:
+            for uploaded in UploadedFile.query.order_by(UploadedFile.id):
+                if has_snapshot(uploaded.file_hash):
+                    stats = ingest_chunks(snapshot_chunks([uploaded.file_hash]), file_id=uploaded.id, summaries=False)
+                else:
+                    snapshot = SnapshotWriter(uploaded.file_hash)
+                    snapshots.append(snapshot)
+                    chunks = read_stored_export(os.path.join(app.config['UPLOAD_FOLDER'], uploaded.filename))
+                    stats = ingest_chunks(chunks, snapshot=snapshot, file_id=uploaded.id, summaries=False)
+                uploaded.row_count = stats["rows"]
+            # Summaries once over everything instead of per file
+            classify_dimensions(db.session)
+            rebuild_summaries(db.session)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for snapshot in snapshots:
+                snapshot.discard()
+            raise
+        for snapshot in snapshots:
+            snapshot.commit()
+    report_cache.clear()
+
+@app.cli.command('rebuild-database')
+def rebuild_database_command():
+    """Reload all data tables from the Parquet snapshots (or CSV copies) of the uploads."""
+    started = time.perf_counter()
+    rebuild_database()
+    click.echo(f"Przebudowano bazę z {len(stored_file_hashes())} plików w {time.perf_counter() - started:.1f}s.")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,586 @@
+import io
+import os
+import re
+import sys
+import csv
+import gzip
+import json
+import math
+import time
+import random
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import subprocess
+import urllib.error
+import urllib.request
+import zipfile
+from contextlib import contextmanager
+
+import click
+
+try:
+    import resource
+except ImportError:  # peak RSS is only reported on Unix
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COLUMNS = [
+    'cykl dydaktyczny', 'kod przedmiotu', 'nazwa przedmiotu', 'język prowadzenia przedmiotu',
+    'id zajęć', 'kod zajęć', 'opis zajęć', 'nr grupy', 'id osoby', 'tytul', 'imie', 'nazwisko',
+    'kod jednostki', 'jednostka', 'id pytania', 'kolejność', 'treść pytania', 'wartość',
+    'opis odpowiedzi (PL)', 'opis odpowiedzi (EN)', 'odp_na_wartosc', 'odp_na_pytanie',
+    'udzial_wart_w_pytaniu', 'uprawnieni', 'udzial_wartosci_w_uprawnionych'
+]
+
+# The first unit is the one the reports treat as "own" (REPORT_PARAMETERS['own_unit'] in app.py)
+UNITS = [
+    ('WNS', 'Wydział Nauk Społecznych'),
+    ('WF', 'Wydział Filologiczny'),
+    ('WPiA', 'Wydział Prawa i Administracji'),
+    ('WMFiI', 'Wydział Matematyki, Fizyki i Informatyki'),
+    ('WE', 'Wydział Ekonomiczny'),
+    ('WB', 'Wydział Biologii'),
+    ('WH', 'Wydział Historyczny'),
+    ('WNoZ', 'Wydział Nauk o Ziemi'),
+]
+
+INITIAL_QUESTIONS = {
+    'Wykład': "Czy na początku wykładów cel i zakres przedmiotu został jasno określony?",
+    'Ćwiczenia': "Czy na początku ćwiczeń ich cel i zakres zostały jasno określone?",
+}
+
+EXCLUDED_QUESTIONS = [
+    "Czy stopień trudności ocenianych ćwiczeń, w porównaniu z innymi, był duży?",
+    "Oceń własną frekwencję na wykładach",
+]
+
+RATED_QUESTIONS = [
+    "Czy prowadzący był przygotowany do zajęć?",
+    "Czy prowadzący przekazywał wiedzę w sposób zrozumiały?",
+    "Czy prowadzący zachęcał do samodzielnego myślenia?",
+    "Czy prowadzący był dostępny w czasie konsultacji?",
+    "Czy zasady zaliczenia były jasno określone?",
+    "Czy materiały dydaktyczne były przydatne?",
+    "Czy prowadzący szanował studentów?",
+    "Jak ogólnie oceniasz zajęcia?",
+]
+
+ANSWERS = [
+    ('zdecydowanie nie', 'definitely not'),
+    ('raczej nie', 'rather not'),
+    ('trudno powiedzieć', 'hard to say'),
+    ('raczej tak', 'rather yes'),
+    ('zdecydowanie tak', 'definitely yes'),
+]
+ANSWER_WEIGHTS = [1, 2, 3, 5, 6]
+
+TITLES = ['mgr', 'dr', 'dr inż.', 'dr hab.', 'prof. dr hab.']
+FIRST_NAMES = ['Łukasz', 'Małgorzata', 'Grzegorz', 'Żaneta', 'Krzysztof', 'Agnieszka', 'Paweł', 'Józefa', 'Bartłomiej', 'Ewa']
+LAST_NAMES = ['Wójcik', 'Kowalczyk', 'Zieliński', 'Szymańska', 'Woźniak', 'Dąbrowski', 'Kozłowska', 'Jankowski', 'Mazur', 'Krawczyk']
+SUBJECT_WORDS = ['Podstawy', 'Wstęp do', 'Zagadnienia', 'Seminarium z', 'Metodologia']
+SUBJECT_TOPICS = ['socjologii', 'ekonometrii', 'językoznawstwa', 'prawa cywilnego', 'fizyki ciała stałego', 'genetyki', 'historii Śląska', 'geologii']
+
+REPORT_ROUTES = [
+    '/unique_classes', '/tabela21', '/tabela22', '/tabela31', '/tabela32', '/tabela33', '/tabela34',
+    '/analiza_wynikow', '/dashboard', '/data'
+]
+
+
+SIZE_UNITS = {'kb': 2 ** 10, 'mb': 2 ** 20, 'gb': 2 ** 30}
+
+
+def decimal(value):
+    return f"{value:.4f}".replace('.', ',')
+
+
+# Texts for slots 1.. of the questionnaire: the two excluded questions first
+def question_texts(count):
+    texts = EXCLUDED_QUESTIONS[:max(0, count - 1)]
+    for i in range(count - 1 - len(texts)):
+        text = RATED_QUESTIONS[i % len(RATED_QUESTIONS)]
+        if i >= len(RATED_QUESTIONS):
+            text = f"{text} (część {i // len(RATED_QUESTIONS) + 1})"
+        texts.append(text)
+    return texts
+
+
+def unit_list(count):
+    return [UNITS[i] if i < len(UNITS) else (f'INS{i}', f'Instytut Badań Stosowanych nr {i}') for i in range(count)]
+
+
+# Text file for the export; .gz and .zip paths are compressed while writing
+@contextmanager
+def open_export_file(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'wt', newline='', encoding='utf-8') as f:
+            yield f
+    elif path.endswith('.zip'):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            with io.TextIOWrapper(archive.open('eksport.csv', 'w', force_zip64=True), newline='', encoding='utf-8') as f:
+                yield f
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            yield f
+
+
+# Row count for a size given as rows ("10000") or as plain CSV bytes ("10MB", "1GB")
+def parse_size(value, bytes_per_row):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([kmg]b)?', value.strip().lower())
+    if not match:
+        raise click.BadParameter(f"Nieprawidłowy rozmiar: {value}")
+    if match[2] is None:
+        return int(float(match[1]))
+    return max(1, int(float(match[1]) * SIZE_UNITS[match[2]] / bytes_per_row))
+
+
+# Writes a USOS Ankieter export with exactly `rows` rows. Every (class, teacher)
+# pair answers each question with the five values 1-5, so the row count fixes
+# the number of pairs; classes default to about 1.25 teachers per class.
+def generate_export(path, rows, teachers=50, classes=None, units=5, questions=8, subjects=None,
+                    cycle='2023/24Z', seed=0):
+    if questions < 1 or units < 1 or teachers < 1:
+        raise ValueError("Liczba pytań, jednostek i prowadzących musi być dodatnia.")
+    rng = random.Random(seed)
+    pairs = math.ceil(rows / (questions * len(ANSWERS)))
+    classes = classes or max(1, math.ceil(pairs * 0.8))
+    if pairs > classes * teachers:
+        raise ValueError(f"{rows} wierszy wymaga co najmniej {pairs} par zajęcia-prowadzący, "
+                         f"a {classes} zajęć i {teachers} prowadzących daje tylko {classes * teachers}.")
+    subjects = subjects or max(1, classes // 3)
+    unit_rows = unit_list(units)
+    # Slot 0 differs between lectures and classes; ids follow the slot order
+    texts_by_type = {typ: [(500 if typ == 'Ćwiczenia' else 501, text)] + list(enumerate(question_texts(questions), start=502))
+                     for typ, text in INITIAL_QUESTIONS.items()}
+
+    teacher_rows = [
+        (10000 + i, rng.choice(TITLES), rng.choice(FIRST_NAMES), f"{rng.choice(LAST_NAMES)}-{i}", rng.choice(unit_rows))
+        for i in range(teachers)
+    ]
+    subject_rows = [
+        (f"{unit_rows[i % units][0]}-{i:04d}", f"{rng.choice(SUBJECT_WORDS)} {rng.choice(SUBJECT_TOPICS)} {i}",
+         rng.choice(['polski', 'polski', 'angielski']))
+        for i in range(subjects)
+    ]
+    class_rows = []
+    for i in range(classes):
+        kod, nazwa, jezyk = rng.choice(subject_rows)
+        typ = rng.choice(list(INITIAL_QUESTIONS))
+        class_rows.append((100000 + i, f"{kod}-{typ[:3].upper()}", typ, kod, nazwa, jezyk,
+                           rng.randint(1, 4), rng.randint(10, 120), rng.randrange(teachers)))
+
+    written = 0
+    with open_export_file(path) as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(COLUMNS)
+        for k in range(pairs):
+            id_zajec, kod_zajec, typ, kod, nazwa, jezyk, grupa, uprawnieni, offset = class_rows[k % classes]
+            # Consecutive passes over the classes give each one its next teacher
+            id_osoby, tytul, imie, nazwisko, (kod_jednostki, jednostka) = teacher_rows[(offset + k // classes) % teachers]
+            answered = rng.randint(0, uprawnieni)
+            for order, (id_pytania, text) in enumerate(texts_by_type[typ], start=1):
+                counts = [0] * len(ANSWERS)
+                for answer in rng.choices(range(len(ANSWERS)), ANSWER_WEIGHTS, k=answered):
+                    counts[answer] += 1
+                for value, (opis_pl, opis_en) in enumerate(ANSWERS, start=1):
+                    if written == rows:
+                        return written
+                    count = counts[value - 1]
+                    writer.writerow([
+                        cycle, kod, nazwa, jezyk, id_zajec, kod_zajec, typ, grupa, id_osoby, tytul, imie, nazwisko,
+                        kod_jednostki, jednostka, id_pytania, order, text, value, opis_pl, opis_en, count, answered,
+                        decimal(count / answered) if answered else '0', uprawnieni, decimal(count / uprawnieni)
+                    ])
+                    written += 1
+    return written
+
+
+# Runs inside a fresh interpreter: imports the app against an empty database in
+# `workdir`, uploads the export and renders every report once with a cold cache.
+def measure_export(csv_path, workdir, engine, memory):
+    os.chdir(workdir)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+    sys.path.insert(0, REPO_DIR)
+    import app as ankieter
+    from sqlalchemy import event
+
+    ankieter.app.config['MAX_CONTENT_LENGTH'] = None
+    ankieter.app.config['REPORT_ENGINE'] = engine
+    client = ankieter.app.test_client()
+    statements = [0]
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    with ankieter.app.app_context():
+        event.listen(ankieter.db.engine, 'before_cursor_execute', count)
+
+    def timed(step):
+        statements[0] = 0
+        if memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        step()
+        return {
+            "seconds": round(time.perf_counter() - start, 4),
+            "statements": statements[0],
+            "peak_mb": round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2) if memory else None,
+            # Whole process (C buffers of the parser and SQLite included), peak so far
+            "rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None
+        }
+
+    def upload():
+        with open(csv_path, 'rb') as f:
+            response = client.post('/', data={'file': (f, os.path.basename(csv_path))}, content_type='multipart/form-data')
+        if response.status_code != 302:
+            raise RuntimeError(f"Upload zwrócił kod {response.status_code}")
+        while ankieter.ingest_queue.busy():
+            time.sleep(0.01)
+        failed = [job.error for job in ankieter.ingest_queue.all() if job.status == 'failed']
+        if failed:
+            raise RuntimeError(f"Import nie powiódł się: {failed[0]}")
+
+    def render(route):
+        def step():
+            ankieter.report_cache.clear()
+            ankieter.report_dataset = None  # every page pays for its own scan
+            response = client.get(route)
+            response.get_data()  # drains streamed pages
+            if response.status_code != 200:
+                raise RuntimeError(f"{route} zwrócił kod {response.status_code}")
+        return step
+
+    if memory:
+        tracemalloc.start()
+    results = {"ingest": timed(upload)}
+    for route in REPORT_ROUTES:
+        results[route] = timed(render(route))
+    ankieter.ingest_queue.executor.shutdown()
+    return results
+
+
+def compare_results(baseline, current, tolerance, min_seconds, min_mb):
+    regressions = []
+    for size, steps in current["results"].items():
+        for step, now in steps.items():
+            before = baseline["results"].get(size, {}).get(step)
+            if before is None:
+                continue
+            if now["seconds"] > before["seconds"] * (1 + tolerance) and now["seconds"] - before["seconds"] > min_seconds:
+                regressions.append(f"{size} {step}: czas {before['seconds']}s -> {now['seconds']}s")
+            if now["statements"] > before["statements"]:
+                regressions.append(f"{size} {step}: zapytania SQL {before['statements']} -> {now['statements']}")
+            if (now["peak_mb"] is not None and before["peak_mb"] is not None
+                    and now["peak_mb"] > before["peak_mb"] * (1 + tolerance) and now["peak_mb"] - before["peak_mb"] > min_mb):
+                regressions.append(f"{size} {step}: pamięć {before['peak_mb']} MB -> {now['peak_mb']} MB")
+            before_rss, now_rss = before.get("rss_mb"), now.get("rss_mb")
+            if (now_rss is not None and before_rss is not None
+                    and now_rss > before_rss * (1 + tolerance) and now_rss - before_rss > min_mb):
+                regressions.append(f"{size} {step}: RSS {before_rss} MB -> {now_rss} MB")
+    return regressions
+
+
+def print_results(results):
+    for size, steps in results.items():
+        for step, values in steps.items():
+            peak = '-' if values["peak_mb"] is None else values["peak_mb"]
+            rss = '-' if values.get("rss_mb") is None else values["rss_mb"]
+            click.echo(f"{size:>9}  {step:<17}{values['seconds']:>10}{values['statements']:>8}{peak:>13}{rss:>10}")
+
+
+# Runs inside a server process: the app against the shared database in
+# `workdir`, served by Werkzeug with one thread per request.
+def serve(workdir, port):
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import app as ankieter
+
+    ankieter.app.config['MAX_CONTENT_LENGTH'] = None
+    ankieter.app.run(port=port, threaded=True, use_reloader=False)
+
+
+def http_get(url, timeout=120):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.status, response.read()
+
+
+def http_upload(url, path):
+    boundary = f'ankieter-{time.time_ns()}'
+    with open(path, 'rb') as f:
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{os.path.basename(path)}"\r\n'
+                f'Content-Type: text/csv\r\n\r\n').encode() + f.read() + f'\r\n--{boundary}--\r\n'.encode()
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+
+
+def wait_for_jobs(base_url, timeout=1800):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = json.loads(http_get(base_url + '/jobs')[1])
+        if not any(job['status'] in ('queued', 'running') for job in jobs):
+            return jobs
+        time.sleep(0.2)
+    raise RuntimeError("Import nie zakończył się w wyznaczonym czasie.")
+
+
+def start_servers(workdir, deployment, workers, port):
+    env = dict(os.environ, DEPLOYMENT=deployment, LOG_LEVEL='WARNING',
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'load.db'))
+    servers, urls = [], []
+    for i in range(workers):
+        log = open(os.path.join(workdir, f'server-{i}.log'), 'w')
+        command = [sys.executable, os.path.abspath(__file__), 'serve', workdir, '--port', str(port + i)]
+        servers.append(subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT))
+        urls.append(f'http://127.0.0.1:{port + i}')
+        # One at a time, so the startup migrations do not race each other
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                http_get(urls[-1] + '/jobs', timeout=5)
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if servers[-1].poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"Serwer {i} nie wystartował, zob. {log.name}")
+                time.sleep(0.2)
+    return servers, urls
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+
+def latency_summary(samples):
+    seconds = [s for s, error in samples if error is None]
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(seconds),
+        "p50": percentile(seconds, 0.5),
+        "p95": percentile(seconds, 0.95),
+        "p99": percentile(seconds, 0.99),
+        "max": round(max(seconds), 3) if seconds else None,
+    }
+
+
+# Readers request the reports in a loop (a unique query parameter bypasses the
+# report cache, so every request reads the database) first with the database
+# idle and then while the big export is being ingested by the first server.
+def load_test(workdir, deployment, workers, readers, rows, base_rows, idle_seconds, port, seed):
+    base_csv = os.path.join(workdir, 'base.csv')
+    load_csv = os.path.join(workdir, 'load.csv')
+    generate_export(base_csv, base_rows, cycle='2023/24Z', seed=seed)
+    generate_export(load_csv, rows, teachers=max(50, rows // 2000), cycle='2024/25Z', seed=seed + 1)
+
+    servers, urls = start_servers(workdir, deployment, workers, port)
+    try:
+        http_upload(urls[0] + '/', base_csv)
+        wait_for_jobs(urls[0])
+
+        samples = {"idle": [], "ingest": []}
+        phase = ["idle"]
+        stop = threading.Event()
+        errors = []
+
+        def reader(number):
+            i = 0
+            while not stop.is_set():
+                route = REPORT_ROUTES[(number + i) % len(REPORT_ROUTES)]
+                url = f"{urls[(number + i) % len(urls)]}{route}?_={number}-{i}"
+                current = phase[0]
+                start = time.perf_counter()
+                error = None
+                try:
+                    status, _ = http_get(url)
+                except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+                    error = str(getattr(e, 'code', None) or e)
+                    errors.append(f"{route}: {error}")
+                samples[current].append((time.perf_counter() - start, error))
+                i += 1
+
+        threads = [threading.Thread(target=reader, args=(n,), daemon=True) for n in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(idle_seconds)
+
+        phase[0] = "ingest"
+        start = time.perf_counter()
+        http_upload(urls[0] + '/', load_csv)
+        jobs = wait_for_jobs(urls[0])
+        ingest_seconds = time.perf_counter() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    failed = [job['error'] for job in jobs if job['status'] == 'failed']
+    return {
+        "ingest_seconds": round(ingest_seconds, 2),
+        "ingest_failed": failed[0] if failed else None,
+        "idle": latency_summary(samples["idle"]),
+        "ingest": latency_summary(samples["ingest"]),
+        "sample_errors": sorted(set(errors))[:5],
+    }
+
+
+@click.group()
+def cli():
+    """Synthetic USOS Ankieter exports and upload/report benchmarks."""
+
+
+@cli.command('generate')
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--rows', default=10000, show_default=True)
+@click.option('--teachers', default=50, show_default=True)
+@click.option('--classes', type=int, help="Defaults to about 1.25 teachers per class.")
+@click.option('--units', default=5, show_default=True)
+@click.option('--questions', default=8, show_default=True)
+@click.option('--cycle', default='2023/24Z', show_default=True)
+@click.option('--seed', default=0, show_default=True)
+def generate_command(path, rows, teachers, classes, units, questions, cycle, seed):
+    """Write a semicolon-delimited export with the columns upload_file expects (.gz/.zip paths are compressed)."""
+    written = generate_export(path, rows, teachers, classes, units, questions, cycle=cycle, seed=seed)
+    click.echo(f"Zapisano {written} wierszy do {path}.")
+
+
+@cli.command('measure', hidden=True)
+@click.argument('csv_path')
+@click.argument('workdir')
+@click.argument('result_path')
+@click.option('--engine', default='sql')
+@click.option('--memory/--no-memory', default=True)
+def measure_command(csv_path, workdir, result_path, engine, memory):
+    results = measure_export(os.path.abspath(csv_path), os.path.abspath(workdir), engine, memory)
+    with open(result_path, 'w') as f:
+        json.dump(results, f)
+
+
+@cli.command('run')
+@click.option('--sizes', default='1000,10000,100000', show_default=True,
+              help="Comma-separated row counts or uncompressed CSV sizes (10MB, 1GB).")
+@click.option('--teachers', default=50, show_default=True)
+@click.option('--units', default=5, show_default=True)
+@click.option('--questions', default=8, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--engine', type=click.Choice(['sql', 'pandas']), default='sql', show_default=True)
+@click.option('--compression', type=click.Choice(['none', 'gzip', 'zip']), default='none', show_default=True,
+              help="Upload the export as .csv, .csv.gz or .zip.")
+@click.option('--memory/--no-memory', default=True, show_default=True,
+              help="Track peak memory with tracemalloc; it slows Python code down, so times are only comparable between runs with the same setting.")
+@click.option('--output', type=click.Path(dir_okay=False), help="Write the results as JSON.")
+@click.option('--save-baseline', type=click.Path(dir_okay=False), help="Store the results as the new baseline.")
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False), help="Fail on regressions against this baseline.")
+@click.option('--tolerance', default=0.25, show_default=True, help="Allowed relative growth of time and memory.")
+@click.option('--min-seconds', default=0.05, show_default=True, help="Ignore time differences below this.")
+@click.option('--min-mb', default=2.0, show_default=True, help="Ignore memory differences below this.")
+def run_command(sizes, teachers, units, questions, seed, engine, compression, memory, output, save_baseline,
+                baseline_path, tolerance, min_seconds, min_mb):
+    """Time ingestion and every report route for each export size."""
+    config = {"teachers": teachers, "units": units, "questions": questions, "seed": seed,
+              "engine": engine, "compression": compression, "memory": memory}
+    report = {"config": config, "results": {}}
+    suffix = {'none': '.csv', 'gzip': '.csv.gz', 'zip': '.zip'}[compression]
+
+    # Sizes in bytes are converted with the row length of a sample export
+    sample_dir = tempfile.mkdtemp(prefix='ankieter-bench-sample-')
+    try:
+        sample_path = os.path.join(sample_dir, 'sample.csv')
+        sample_rows = generate_export(sample_path, 5000, teachers, units=units, questions=questions, seed=seed)
+        bytes_per_row = os.path.getsize(sample_path) / sample_rows
+    finally:
+        shutil.rmtree(sample_dir, ignore_errors=True)
+
+    click.echo(f"{'rozmiar':>9}  {'krok':<17}{'czas [s]':>10}{'SQL':>8}{'pamięć [MB]':>13}{'RSS [MB]':>10}")
+    for label in [value.strip() for value in sizes.split(',')]:
+        size = parse_size(label, bytes_per_row)
+        # Every size gets its own interpreter and database, so nothing is
+        # cached between sizes and the memory peaks do not add up.
+        workdir = tempfile.mkdtemp(prefix=f'ankieter-bench-{size}-')
+        try:
+            csv_path = os.path.join(workdir, 'export' + suffix)
+            generate_export(csv_path, size, teachers, units=units, questions=questions, seed=seed)
+            if not label.isdigit():
+                click.echo(f"{label}: {size} wierszy, plik {os.path.getsize(csv_path) / 2 ** 20:.1f} MB")
+            result_path = os.path.join(workdir, 'result.json')
+            command = [sys.executable, os.path.abspath(__file__), 'measure', csv_path, workdir, result_path,
+                       '--engine', engine, '--memory' if memory else '--no-memory']
+            finished = subprocess.run(command, capture_output=True, text=True)
+            if finished.returncode != 0:
+                click.echo(finished.stderr[-4000:], err=True)
+                raise click.ClickException(f"Pomiar dla {label} nie powiódł się.")
+            with open(result_path) as f:
+                report["results"][label] = json.load(f)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print_results({label: report["results"][label]})
+
+    for path in (output, save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            click.echo(f"Uwaga: konfiguracja różni się od bazowej {baseline.get('config')}.", err=True)
+        regressions = compare_results(baseline, report, tolerance, min_seconds, min_mb)
+        if regressions:
+            for regression in regressions:
+                click.echo(regression, err=True)
+            raise click.ClickException(f"Wykryto {len(regressions)} regresji względem {baseline_path}.")
+        click.echo(f"Brak regresji względem {baseline_path}.")
+
+
+@cli.command('serve', hidden=True)
+@click.argument('workdir')
+@click.option('--port', default=5057)
+def serve_command(workdir, port):
+    serve(os.path.abspath(workdir), port)
+
+
+@cli.command('load')
+@click.option('--deployment', type=click.Choice(['production', 'development', 'both']), default='both', show_default=True,
+              help="DEPLOYMENT setting of the servers; 'both' runs the test once for each.")
+@click.option('--workers', default=2, show_default=True, help="Server processes sharing one database file.")
+@click.option('--readers', default=8, show_default=True, help="Concurrent report readers.")
+@click.option('--rows', default=200000, show_default=True, help="Rows of the export ingested under load.")
+@click.option('--base-rows', default=20000, show_default=True, help="Rows loaded before the readers start.")
+@click.option('--idle-seconds', default=5.0, show_default=True, help="Reading time before the upload starts.")
+@click.option('--port', default=5057, show_default=True, help="Port of the first server; the others follow.")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help="Write the results as JSON.")
+def load_command(deployment, workers, readers, rows, base_rows, idle_seconds, port, seed, output):
+    """Measure report latency while a large upload is ingested by another server process."""
+    report = {"config": {"workers": workers, "readers": readers, "rows": rows, "base_rows": base_rows}, "results": {}}
+    for mode in (['development', 'production'] if deployment == 'both' else [deployment]):
+        workdir = tempfile.mkdtemp(prefix=f'ankieter-load-{mode}-')
+        try:
+            report["results"][mode] = result = load_test(workdir, mode, workers, readers, rows, base_rows,
+                                                         idle_seconds, port, seed)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        click.echo(f"{mode}: import {result['ingest_seconds']}s"
+                   + (f" NIEUDANY ({result['ingest_failed']})" if result['ingest_failed'] else ''))
+        click.echo(f"  {'faza':<8}{'żądania':>9}{'błędy':>7}{'p50 [s]':>9}{'p95 [s]':>9}{'p99 [s]':>9}{'max [s]':>9}")
+        for phase in ('idle', 'ingest'):
+            values = result[phase]
+            cells = ''.join(f"{'-' if values[key] is None else values[key]:>9}" for key in ('p50', 'p95', 'p99', 'max'))
+            click.echo(f"  {phase:<8}{values['requests']:>9}{values['errors']:>7}{cells}")
+        for error in result["sample_errors"]:
+            click.echo(f"  błąd: {error}")
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    cli()
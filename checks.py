@@ -0,0 +1,313 @@
+import os
+import sys
+import csv
+import json
+import shutil
+import time
+import tempfile
+import subprocess
+
+import click
+
+from benchmark import REPO_DIR, generate_export
+
+
+# Imports the app against the database file `database`, or the configured one
+# when None. The URL is read at import, so checks that need a throwaway
+# database run in a fresh interpreter (see run_isolated).
+def load_app(database=None):
+    if database is not None:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    sys.path.insert(0, REPO_DIR)
+    import app as ankieter
+    return ankieter
+
+
+# Runs a hidden command of this script in a fresh interpreter working in a
+# temporary directory, so uploads/ and snapshots/ of the app are left alone,
+# and returns the JSON result it wrote.
+def run_isolated(command, *arguments):
+    workdir = tempfile.mkdtemp(prefix='ankieter-check-')
+    try:
+        result_path = os.path.join(workdir, 'result.json')
+        finished = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), command, workdir, result_path,
+             *[os.path.abspath(argument) for argument in arguments]],
+            capture_output=True, text=True
+        )
+        if finished.returncode != 0:
+            click.echo(finished.stderr[-4000:], err=True)
+            raise click.ClickException(f"Sprawdzenie {command} nie powiodło się.")
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Body of a hidden command: the app on an empty database in `workdir`, inside
+# an app context; `check` gets the app module and returns the JSON result.
+def run_on_scratch_database(workdir, result_path, check):
+    os.chdir(workdir)
+    ankieter = load_app(os.path.join(workdir, 'check.db'))
+    with ankieter.app.app_context():
+        result = check(ankieter)
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+# Renders every report, runs EXPLAIN QUERY PLAN on each SELECT it issued and
+# returns the plan steps that read the whole Data table without an index.
+# Summary tables are small and meant to be read in full, so they are not flagged.
+def find_full_table_scans(ankieter):
+    db, event = ankieter.db, ankieter.event
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((route, statement, parameters))
+
+    client = ankieter.app.test_client()
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        for route in ankieter.REPORT_ROUTES:
+            client.get(route)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+    full_scans = []
+    with db.engine.connect() as connection:
+        for route, statement, parameters in statements:
+            plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            for step in plan:
+                detail = step[-1]
+                if detail == f'SCAN {ankieter.Data.__tablename__}':
+                    full_scans.append((route, detail, statement))
+    return full_scans
+
+
+# Computes every report with both engines on the current database and returns
+# the names of the tables that differ.
+def compare_report_engines(ankieter):
+    version = ankieter.dataset_version()
+    sql_dataset, frame_dataset = ankieter.SummaryDataset(version), ankieter.FrameDataset(version)
+    differences = []
+    # All cycles together, then every cycle on its own
+    for cycles in [None, *([cykl] for cykl in ankieter.known_cycles())]:
+        sql_engine = sql_dataset.reports(cycles)
+        frame_engine = frame_dataset.reports(cycles)
+        differences += [
+            (name, cycles) for name in ankieter.REPORT_DEFINITIONS
+            if sql_engine.table(name) != frame_engine.table(name)
+        ]
+    return differences
+
+
+# Number of SQL statements every report issues, on an export loaded into an
+# empty database. Reports are batched, so the counts must not depend on how
+# many classes the export has.
+def count_report_statements(ankieter, export):
+    db = ankieter.db
+    stats = ankieter.ingest_chunks(ankieter.read_stored_export(export))
+    db.session.commit()
+    counts = {}
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counts[route] += 1
+
+    client = ankieter.app.test_client()
+    ankieter.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for route in ankieter.REPORT_ROUTES:
+            counts[route] = 0
+            client.get(route)
+    finally:
+        ankieter.event.remove(db.engine, 'before_cursor_execute', count)
+    summary = ankieter.ClassSummary
+    classes = db.session.query(ankieter.func.count(summary.id_zajec.distinct())).scalar()
+    return {'wiersze': stats['rows'], 'zajecia': classes, 'zapytania': counts}
+
+
+# Loads `first` and then the overlapping `second` as two uploads and deletes
+# one of them; what is left has to match the other export loaded on its own:
+# the Data rows (by their export columns) and every report table. Deleting the
+# second upload covers the values it overwrote in rows the first one contains.
+def compare_overlap_delete(ankieter, first, second):
+    db = ankieter.db
+    client = ankieter.app.test_client()
+
+    # Through the upload form and the ingest queue, so the stored copies the
+    # delete restores values from are written as for any upload
+    def upload(export, name):
+        suffix = next(ext for ext in ankieter.ALLOWED_EXTENSIONS if export.lower().endswith(ext))
+        with open(export, 'rb') as f:
+            client.post('/', data={'file': (f, name + suffix)}, content_type='multipart/form-data')
+        while ankieter.ingest_queue.busy():
+            time.sleep(0.01)
+        job = ankieter.ingest_queue.all()[-1]
+        if job.status != 'done':
+            raise RuntimeError(f"Import {export} nie powiódł się: {job.error}")
+        db.session.remove()
+        return ankieter.UploadedFile.query.filter_by(filename=name + suffix).one().id, job
+
+    def delete(file_id):
+        client.post(f'/files/{file_id}/delete')
+        db.session.remove()
+
+    def contents():
+        rows = sorted((tuple(row[1:]) for row in db.session.execute(ankieter.flat_data_query())), key=repr)
+        reports = ankieter.SummaryDataset(ankieter.dataset_version()).reports()
+        return rows, {name: reports.table(name) for name in ankieter.REPORT_DEFINITIONS}
+
+    alone = {}
+    for export, name in ((first, 'pierwszy'), (second, 'drugi')):
+        file_id, _ = upload(export, name)
+        alone[name] = contents()
+        delete(file_id)
+
+    results = []
+    for deleted, kept in (('pierwszy', 'drugi'), ('drugi', 'pierwszy')):
+        uploads = {name: upload(export, name) for export, name in ((first, 'pierwszy'), (second, 'drugi'))}
+        delete(uploads[deleted][0])
+        rows, tables = contents()
+        alone_rows, alone_tables = alone[kept]
+        job = uploads['drugi'][1]
+        results.append({
+            'usuniety': deleted,
+            'wspolne': job.updated + job.skipped,
+            'zaktualizowane': job.updated,
+            'wiersze': len(rows),
+            'wiersze_osobno': len(alone_rows),
+            'wiersze_zgodne': rows == alone_rows,
+            'tabele_rozne': [name for name in ankieter.REPORT_DEFINITIONS if tables[name] != alone_tables[name]],
+        })
+        delete(uploads[kept][0])
+    return results
+
+
+# Copy of an export with odp_na_wartosc raised by one in every `every`-th row,
+# as in a corrected re-export of the same survey
+def change_counts(source, target, every=10):
+    with open(source, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f, delimiter=';'))
+    column = rows[0].index('odp_na_wartosc')
+    for row in rows[1::every]:
+        row[column] = str(int(row[column]) + 1)
+    with open(target, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f, delimiter=';').writerows(rows)
+
+
+@click.group()
+def cli():
+    """Consistency checks of the reports and uploads, on the current or a throwaway database."""
+
+
+@cli.command('query-plans')
+def query_plans_command():
+    """Fail if any report query does a full table SCAN (current database)."""
+    ankieter = load_app()
+    with ankieter.app.app_context():
+        full_scans = find_full_table_scans(ankieter)
+    for route, detail, statement in full_scans:
+        click.echo(f"{route}: {detail}\n    {' '.join(statement.split())}")
+    if full_scans:
+        sys.exit(1)
+    click.echo(f"Plany zapytań dla {len(ankieter.REPORT_ROUTES)} raportów korzystają z indeksów.")
+
+
+@cli.command('report-engines')
+def report_engines_command():
+    """Fail if the SQL and pandas engines produce different report tables (current database)."""
+    ankieter = load_app()
+    with ankieter.app.app_context():
+        differences = compare_report_engines(ankieter)
+    for name, cycles in differences:
+        scope = ', '.join(cycles) if cycles else 'wszystkie cykle'
+        click.echo(f"{name} ({scope}): tabele silników sql i pandas się różnią")
+    if differences:
+        sys.exit(1)
+    click.echo("Silniki sql i pandas dają identyczne tabele.")
+
+
+@cli.command('count-statements', hidden=True)
+@click.argument('workdir')
+@click.argument('result_path')
+@click.argument('export')
+def count_statements_command(workdir, result_path, export):
+    run_on_scratch_database(workdir, result_path, lambda ankieter: count_report_statements(ankieter, export))
+
+
+@cli.command('statement-counts')
+@click.argument('small', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.argument('large', required=False, type=click.Path(exists=True, dir_okay=False))
+def statement_counts_command(small, large):
+    """Fail if a report issues a different number of SQL statements on two export sizes.
+
+    Without arguments, exports of 1000 and 10000 rows are generated."""
+    with tempfile.TemporaryDirectory(prefix='ankieter-exports-') as directory:
+        if small is None or large is None:
+            small, large = os.path.join(directory, 'maly.csv'), os.path.join(directory, 'duzy.csv')
+            generate_export(small, 1000)
+            generate_export(large, 10000)
+        small_result, large_result = [run_isolated('count-statements', export) for export in (small, large)]
+
+    if small_result['zajecia'] == large_result['zajecia']:
+        click.echo(f"Oba eksporty mają po {small_result['zajecia']} zajęć, podaj eksporty o różnej liczbie zajęć.")
+        sys.exit(1)
+    different = False
+    for route in small_result['zapytania']:
+        counts = small_result['zapytania'][route], large_result['zapytania'][route]
+        click.echo(f"{route}: {counts[0]} / {counts[1]} zapytań")
+        different = different or counts[0] != counts[1]
+    if different:
+        sys.exit(1)
+    click.echo(f"Liczba zapytań raportów nie zależy od liczby zajęć "
+               f"({small_result['zajecia']} i {large_result['zajecia']} zajęć).")
+
+
+@cli.command('compare-overlap', hidden=True)
+@click.argument('workdir')
+@click.argument('result_path')
+@click.argument('first')
+@click.argument('second')
+def compare_overlap_command(workdir, result_path, first, second):
+    run_on_scratch_database(workdir, result_path, lambda ankieter: compare_overlap_delete(ankieter, first, second))
+
+
+@cli.command('overlap-delete')
+@click.argument('first', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.argument('second', required=False, type=click.Path(exists=True, dir_okay=False))
+def overlap_delete_command(first, second):
+    """Fail if deleting one of two overlapping uploads leaves anything but the other one.
+
+    Without arguments, the second export is generated as the first one with
+    changed counts in some rows and as many rows again."""
+    with tempfile.TemporaryDirectory(prefix='ankieter-exports-') as directory:
+        if first is None or second is None:
+            # Same classes and seed, so the first 2000 rows of both have the same keys
+            first, second = os.path.join(directory, 'stary.csv'), os.path.join(directory, 'nowy.csv')
+            generate_export(first, 2000, classes=100)
+            generate_export(second, 4000, classes=100)
+            change_counts(second, second)
+        results = run_isolated('compare-overlap', first, second)
+
+    if not results[0]['wspolne']:
+        click.echo("Eksporty nie mają wspólnych wierszy, podaj eksporty, które się pokrywają.")
+        sys.exit(1)
+    click.echo(f"Wspólne wiersze: {results[0]['wspolne']}, w tym zaktualizowane przez drugi plik: "
+               f"{results[0]['zaktualizowane']}.")
+    failed = False
+    for result in results:
+        other = 'drugiego' if result['usuniety'] == 'pierwszy' else 'pierwszego'
+        click.echo(f"Po usunięciu {'pierwszego' if result['usuniety'] == 'pierwszy' else 'drugiego'} pliku zostało "
+                   f"{result['wiersze']} wierszy, sam plik {other} daje {result['wiersze_osobno']}"
+                   + ('' if result['wiersze_zgodne'] else ', wiersze się różnią') + '.')
+        for name in result['tabele_rozne']:
+            click.echo(f"  {name}: tabela różni się od wczytania samego pliku {other}")
+        failed = failed or not result['wiersze_zgodne'] or bool(result['tabele_rozne'])
+    if failed:
+        sys.exit(1)
+    click.echo("Usunięcie każdego z plików zostawia dokładnie dane drugiego.")
+
+
+if __name__ == '__main__':
+    cli()